@@ -1,57 +1,115 @@
 #!/usr/bin/python3
 
-import subprocess
+import os, sys
+import multiprocessing
 from blitzloop import song, util
 
+import library
+import loudness
+import media_utils
+
 parser = util.get_argparser()
 parser.add_argument(
-    'songpath', metavar='SONGPATH', help='path to the song file')
+    'songpath', metavar='SONGPATH', nargs='+',
+    help='path to the song file (song files or library directories with --library)')
+parser.add_argument(
+    '--mixes', action='store_true',
+    help='also store gains for the instrumental track and each stem (track_gain_<mix>)')
+parser.add_argument(
+    '--library', action='store_true', help='process every song found under the given paths')
+parser.add_argument(
+    '--jobs', type=int, default=os.cpu_count(), help='maximum number of songs (ffmpeg processes) at once')
+parser.add_argument(
+    '--force', action='store_true', help='analyze even if the audio is unchanged')
 opts = util.get_opts()
 
-s = song.Song(opts.songpath)
-
-if s.channels == 0:
-    af = ''
-elif s.channels == 1:
-    # Take the second track (with vocals)
-    af = 'pan=stereo|c0=c2|c1=c3,'
-else:
-    # Mix all tracks together
-    c0 = '+'.join("c%d" % (i*2) for i in range(s.channels + 1))
-    c1 = '+'.join("c%d" % (i*2+1) for i in range(s.channels + 1))
-    af = 'pan=stereo|c0=%s|c1=%s,' % (c0, c1)
-
-cmd = [
-    "ffmpeg", "-hide_banner", "-nostats",
-    "-i", s.audiofile,
-    "-af", "%sreplaygain" % af,
-    "-f", "null", "-"
-]
-
-p = subprocess.run(cmd, stderr=subprocess.PIPE, check=True)
-
-track_gain = None
-track_peak = None
-
-for line in p.stderr.split(b"\n"):
-    line = line.split()
-    if b"track_gain" in line:
-        assert line[-1] == b"dB"
-        track_gain = float(line[-2])
-    if b"track_peak" in line:
-        track_peak = float(line[-1])
-
-if track_gain is None or track_peak is None:
-    print("Failed to parse ffmpeg output! Output follows:")
-    print(p.stderr.decode("utf-8"))
-    sys.exit(1)
-
-print("track_gain = %.04f" % track_gain)
-print("track_peak = %.04f" % track_peak)
-
-s.song["track_gain"] = "%.06f" % track_gain
-s.song["track_peak"] = "%.06f" % track_peak
-
-with open(opts.songpath, "wb") as fd:
-    fd.write(s.dump().encode("utf-8"))
+if not opts.library and len(opts.songpath) != 1:
+    parser.error("processing multiple songs requires --library")
+
+def fingerprint(s, quick=False):
+    return media_utils.fingerprint(s.audiofile, s.pathbase, quick)
+
+def unmeasured(s):
+    return [i for i in s.song.get(loudness.UNMEASURED_KEY, "").split(",") if i]
+
+def unchanged(s, mixes):
+    # Mixes that couldn't be measured last time have no keys, but count as
+    # done
+    done = unmeasured(s)
+    keys = ["track_%s%s" % (k, "" if name == "track" else "_" + name)
+            for name in mixes if name not in done for k in ("gain", "peak")]
+    old = s.song.get("track_gain_source")
+    if opts.force or old is None or not all(k in s.song for k in keys):
+        return False
+    size, mtime, h = old.split(":")
+    new_size, new_mtime, _ = fingerprint(s, quick=True).split(":")
+    if size != new_size:
+        return False
+    if mtime == new_mtime:
+        return True
+    # Touched but possibly not modified
+    return fingerprint(s).split(":")[2] == h
+
+def process(songpath):
+    try:
+        s = song.Song(songpath)
+
+        channels, mixes = loudness.song_mixes(s.channels, opts.mixes)
+
+        if unchanged(s, mixes):
+            return songpath, "skipped", []
+
+        results = loudness.analyze_file(s.audiofile, channels, mixes)
+
+        log = []
+        # Mixes not analyzed this time (no --mixes) keep their state
+        silent = [i for i in unmeasured(s) if i not in mixes]
+        for name, res in results.items():
+            suffix = "" if name == "track" else "_" + name
+            if res is None:
+                log.append("track_gain%s: silent or too short to measure, not set" % suffix)
+                s.song.pop("track_gain" + suffix, None)
+                s.song.pop("track_peak" + suffix, None)
+                silent.append(name)
+                continue
+            gain, peak = res
+            log.append("track_gain%s = %.04f" % (suffix, gain))
+            log.append("track_peak%s = %.04f" % (suffix, peak))
+            s.song["track_gain" + suffix] = "%.06f" % gain
+            s.song["track_peak" + suffix] = "%.06f" % peak
+        if silent:
+            s.song[loudness.UNMEASURED_KEY] = ",".join(silent)
+        else:
+            s.song.pop(loudness.UNMEASURED_KEY, None)
+        s.song["track_gain_source"] = fingerprint(s)
+
+        with open(songpath, "wb") as fd:
+            fd.write(s.dump().encode("utf-8"))
+        return songpath, "ok", log
+    except Exception as e:
+        return songpath, "error", ["%s: %s" % (type(e).__name__, e)]
+
+if not opts.library:
+    songpath, status, log = process(opts.songpath[0])
+    if status == "skipped":
+        print("Audio unchanged since the last analysis, use --force to redo it")
+    elif status == "error":
+        print("Failed to analyze %s: %s" % (songpath, log[0]))
+        sys.exit(1)
+    for line in log:
+        print(line)
+    sys.exit(0)
+
+counts = {"ok": 0, "skipped": 0, "error": 0}
+songs = list(library.find_songs(opts.songpath))
+# Each worker runs one ffmpeg decoder at a time, so this bounds them too
+with multiprocessing.Pool(max(1, opts.jobs)) as pool:
+    for songpath, status, log in pool.imap_unordered(process, songs):
+        counts[status] += 1
+        if status == "ok":
+            print("%s: %s" % (songpath, ", ".join(log[:2])))
+        elif status == "error":
+            print("FAIL %s: %s" % (songpath, log[0]), file=sys.stderr)
 
+print("%d analyzed, %d unchanged, %d failed" % (counts["ok"], counts["skipped"], counts["error"]))
+sys.exit(1 if counts["error"] else 0)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+import os, sys, time, json, argparse, platform, functools
+
+import construct
+
+import joysound_synth
+from joysound_utils import LZSSAdapter, LZSS_EFFORT, lzss_compress, lzss_implementation
+from joy02_format import Joy02File
+from ujk_format import UJKFile
+from profiling import percentile
+
+BENCHMARKS = ["lzss_compress", "lzss_decompress", "joy02_parse", "ujk_parse", "joy02_import", "joyu2_import"]
+
+parser = argparse.ArgumentParser(
+    description="Time the JOY-02/UJK parsers and importers on synthetic songs")
+parser.add_argument(
+    '--blocks', type=int, default=100, help='lyric blocks per song')
+parser.add_argument(
+    '--chars', type=int, default=12, help='characters per block')
+parser.add_argument(
+    '--furi-density', type=float, default=0.3,
+    help='fraction of characters that are kanji with furigana')
+parser.add_argument(
+    '--events', type=int, default=2, help='speed change events per block')
+parser.add_argument(
+    '--glyphs', type=int, default=256, help='glyphs in the UJK fonts')
+parser.add_argument(
+    '--audio-blocks', type=int, default=200, help='audio blocks in the UJK file')
+parser.add_argument(
+    '--seed', type=int, default=0, help='random seed for the lyrics')
+parser.add_argument(
+    '--effort', type=int, default=LZSS_EFFORT, help='LZSS compressor effort (match candidates tried)')
+parser.add_argument(
+    '-n', '--repeat', type=int, default=5, help='runs of each benchmark')
+parser.add_argument(
+    '-b', '--bench', action='append', choices=BENCHMARKS,
+    help='only run this benchmark (may be repeated)')
+parser.add_argument(
+    '-o', '--output', metavar='JSON',
+    help='append the results to this file (a JSON list of runs)')
+parser.add_argument(
+    '--save-corpus', metavar='DIR',
+    help='also write the generated song.joy02 and song.ujk to DIR')
+opts = parser.parse_args()
+
+def new_song():
+    from blitzloop.song import Song
+    song = Song()
+    song.timing.add(0, 0)
+    song.timing.add(1, 1)
+    return song
+
+def lyrics_blob(ujk):
+    offsets = UJKFile.parse(ujk).offsets
+    return ujk[offsets.lyrics_off:offsets.lyrics_off + offsets.lyrics_size]
+
+# Each benchmark is a generator of runs: it does any setup, then yields the
+# run itself as a callable, which is all that is timed
+
+def bench_lzss_compress(joy02, ujk):
+    data = LZSSAdapter(construct.GreedyBytes).parse(lyrics_blob(ujk))
+    while True:
+        yield functools.partial(lzss_compress, data, opts.effort)
+
+def bench_lzss_decompress(joy02, ujk):
+    blob = lyrics_blob(ujk)
+    adapter = LZSSAdapter(construct.GreedyBytes)
+    while True:
+        yield functools.partial(adapter.parse, blob)
+
+def bench_joy02_parse(joy02, ujk):
+    while True:
+        yield functools.partial(Joy02File.parse, joy02)
+
+def bench_ujk_parse(joy02, ujk):
+    while True:
+        yield functools.partial(UJKFile.parse, ujk)
+
+# The importers modify the parsed blocks, so every run gets a fresh parse
+
+def bench_joy02_import(joy02, ujk):
+    from import_joy02 import Joy02Importer
+    while True:
+        js = Joy02File.parse(joy02)
+        yield Joy02Importer(new_song(), js.lyrics, js.timing, js.metadata).import_all
+
+def bench_joyu2_import(joy02, ujk):
+    from import_ujk import JoyU2Importer
+    while True:
+        yield JoyU2Importer(UJKFile.parse(ujk), new_song()).import_all
+
+def run(name, joy02, ujk):
+    gen = globals()["bench_" + name](joy02, ujk)
+    times = []
+    for i in range(opts.repeat):
+        fn = next(gen)
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    gen.close()
+    times.sort()
+    return {
+        "runs": times,
+        "min": times[0],
+        "median": percentile(times, 50),
+        "mean": sum(times) / len(times),
+        "max": times[-1],
+    }
+
+params = joysound_synth.SynthParams(
+    blocks=opts.blocks, chars=opts.chars, furi_density=opts.furi_density,
+    events=opts.events, glyphs=opts.glyphs, audio_blocks=opts.audio_blocks,
+    seed=opts.seed)
+
+joy02 = joysound_synth.build_joy02(params)
+ujk = joysound_synth.build_ujk(params, opts.effort)
+
+def check_corpus(joy02, ujk):
+    """Parse the generated files back, so that a generator which drifted
+    from the schemas fails here rather than in the benchmarks."""
+    js = Joy02File.parse(joy02)
+    if len(js.lyrics.blocks) != params.blocks:
+        raise Exception("JOY-02 corpus has %d blocks, expected %d" % (len(js.lyrics.blocks), params.blocks))
+    u = UJKFile.parse(ujk)
+    for i, size in enumerate(u.lyrics.value.sizes):
+        if len(size.lyrics.blocks) != params.blocks:
+            raise Exception("UJK corpus has %d blocks in size %d, expected %d" % (
+                len(size.lyrics.blocks), i + 1, params.blocks))
+    for i, font in enumerate(u.fonts.value.fonts):
+        if len(font.chars) != params.glyphs:
+            raise Exception("UJK corpus has %d glyphs in font %d, expected %d" % (
+                len(font.chars), i + 1, params.glyphs))
+
+check_corpus(joy02, ujk)
+
+if opts.save_corpus:
+    os.makedirs(opts.save_corpus, exist_ok=True)
+    with open(os.path.join(opts.save_corpus, "song.joy02"), "wb") as fd:
+        fd.write(joy02)
+    with open(os.path.join(opts.save_corpus, "song.ujk"), "wb") as fd:
+        fd.write(ujk)
+
+results = {
+    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    "python": platform.python_version(),
+    "construct": construct.__version__,
+    "params": params.as_dict(),
+    "effort": opts.effort,
+    "lzss": lzss_implementation(),
+    "sizes": {"joy02": len(joy02), "ujk": len(ujk)},
+    "repeat": opts.repeat,
+    "benchmarks": {},
+}
+
+print("JOY-02: %d bytes, UJK: %d bytes, %d runs each, %s LZSS" % (
+    len(joy02), len(ujk), opts.repeat, results["lzss"]))
+print("%-16s %10s %10s %10s" % ("benchmark", "min", "median", "max"))
+for name in opts.bench or BENCHMARKS:
+    res = run(name, joy02, ujk)
+    results["benchmarks"][name] = res
+    print("%-16s %8.02fms %8.02fms %8.02fms" % (
+        name, 1000 * res["min"], 1000 * res["median"], 1000 * res["max"]))
+
+if opts.output:
+    runs = []
+    if os.path.exists(opts.output):
+        with open(opts.output) as fd:
+            runs = json.load(fd)
+    runs.append(results)
+    with open(opts.output, "w") as fd:
+        json.dump(runs, fd, indent=2)
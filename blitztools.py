@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import os, sys
+
+# Subcommands and the scripts they run. Nothing is imported until a
+# subcommand is picked, so each one only pays for its own dependencies
+# (construct, numpy, blitzloop graphics, mpv...). The same goes for this
+# script's own imports, which is why they are local.
+COMMANDS = [
+    ("import-ujk", "import_ujk", "import a UJK file into a song directory"),
+    ("import-joy02", "import_joy02", "convert a JOY-02 file into a song file"),
+    ("import-daemon", "import_daemon", "import files dropped into a spool directory"),
+    ("export-lyrics", "export_lyrics", "export the lyrics of a song as text"),
+    ("export-ass", "export_ass", "export songs as ASS subtitles"),
+    ("export-joysound-prj", "export_joysound_prj", "export songs as Joysound projects"),
+    ("render", "render", "render a song to a video file"),
+    ("replaygain", "apply_replaygain", "measure and store track gain for songs"),
+    ("list", "listsongs", "list the songs in a song directory"),
+    ("bench-import", "bench_import", "benchmark the JOY-02/UJK parsers and importers"),
+]
+
+STARTUP_RUNS = 5
+
+def usage(fd=sys.stdout):
+    print("Usage: %s COMMAND [ARGS...]" % os.path.basename(sys.argv[0]), file=fd)
+    print(file=fd)
+    print("Commands:", file=fd)
+    for name, module, desc in COMMANDS:
+        print("  %-20s %s" % (name, desc), file=fd)
+    print("  %-20s %s" % ("startup", "measure the startup time of each command"), file=fd)
+    print(file=fd)
+    print("Run %s COMMAND --help for the options of a command." % os.path.basename(sys.argv[0]), file=fd)
+
+def time_command(args, runs):
+    """Median wall time of running args to completion, or None if it
+    fails (e.g. a missing dependency)."""
+    import time, subprocess
+    times = []
+    for i in range(runs):
+        t = time.perf_counter()
+        res = subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - t)
+        if res.returncode != 0:
+            return None
+    times.sort()
+    return times[len(times) // 2]
+
+def startup(args):
+    """Time "COMMAND --help" for each command, which is dominated by
+    imports, against a bare interpreter."""
+    import json, argparse
+    parser = argparse.ArgumentParser(prog="%s startup" % os.path.basename(sys.argv[0]),
+                                     description="Measure the startup time of each command")
+    parser.add_argument("commands", metavar="COMMAND", nargs="*",
+                        help="commands to time (default: all)")
+    parser.add_argument("-n", "--runs", type=int, default=STARTUP_RUNS,
+                        help="runs of each command (the median is reported)")
+    parser.add_argument("-o", "--output", metavar="JSON", help="also write the results to this file")
+    opts = parser.parse_args(args)
+    known = [name for name, module, desc in COMMANDS]
+    for name in opts.commands:
+        if name not in known:
+            parser.error("unknown command %s" % name)
+    names = opts.commands or known
+    me = os.path.abspath(__file__)
+
+    results = {}
+    results["python"] = time_command([sys.executable, "-c", "pass"], opts.runs)
+    results["help"] = time_command([sys.executable, me, "--help"], opts.runs)
+    for name in names:
+        results[name] = time_command([sys.executable, me, name, "--help"], opts.runs)
+
+    for name, t in results.items():
+        if t is None:
+            print("%-20s    failed" % name)
+        else:
+            print("%-20s %7.01fms" % (name, 1000 * t))
+
+    if opts.output:
+        with open(opts.output, "w") as fd:
+            json.dump({"runs": opts.runs, "median_s": results}, fd, indent=2)
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        usage()
+        return
+    cmd = sys.argv[1]
+    if cmd == "startup":
+        startup(sys.argv[2:])
+        return
+    for name, module, desc in COMMANDS:
+        if name == cmd:
+            break
+    else:
+        print("Unknown command: %s" % cmd, file=sys.stderr)
+        usage(sys.stderr)
+        sys.exit(1)
+
+    # The scripts parse sys.argv themselves (run_module replaces argv[0]
+    # with the script path)
+    sys.argv = [sys.argv[0]] + sys.argv[2:]
+    import runpy
+    runpy.run_module(module, run_name="__main__", alter_sys=True)
+
+if __name__ == "__main__":
+    main()
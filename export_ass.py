@@ -17,92 +17,106 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
 
 import os
-import time
-import subprocess
-import argparse
+import sys
+import json
+import multiprocessing
 
-import ctypes
+from blitzloop import song, util
 
-from blitzloop import graphics, layout, mpvplayer, song, util
+import library
+import lyric_export
 
 parser = util.get_argparser()
 parser.add_argument(
-    'songpath', metavar='SONGPATH', help='path to the song file')
+    'songpath', metavar='SONGPATH', nargs='+', help='path to the song file (song files or directories with --batch)')
 parser.add_argument(
     '--variant', type=int, default=0, help='song variant')
+parser.add_argument(
+    '--batch', action='store_true', help='export all variants of every song found to .ass files')
+parser.add_argument(
+    '--tag', action='append', help='in batch mode, only export variants using this tag')
+parser.add_argument(
+    '--output-dir', help='in batch mode, write into this tree instead of next to each song')
+parser.add_argument(
+    '--jobs', type=int, default=os.cpu_count(), help='number of worker processes in batch mode')
+parser.add_argument(
+    '--force', action='store_true', help='export even if the outputs are newer than the song')
 opts = util.get_opts()
 
-s = song.Song(opts.songpath)
-
-variant = s.variants[list(s.variants.keys())[opts.variant]]
-tags = set(i for i in variant.tag_list)
-
-print("""
-[Script Info]
-Title: Default Aegisub file
-ScriptType: v4.00+
-WrapStyle: 0
-ScaledBorderAndShadow: yes
-YCbCr Matrix: TV.601
-PlayResX: 1920
-PlayResY: 1080
-
-[Aegisub Project Garbage]
-Last Style Storage: Default
-Audio File: dummy.flac
-Video File: dummy.flac
-Video AR Mode: 4
-Video AR Value: 1.777778
-Video Zoom Percent: 1.000000
-Active Line: 29
-Video Position: 11024
-
-[V4+ Styles]
-Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: Default,Rounded Mplus 1c,90,&H00FFFFFF,&H00ffc080,&H00FF9664,&H6A000000,0,0,0,0,100,100,0,0,1,2.5,3,8,20,20,10,1
-
-[Events]
-Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-""")
-
-def ft(t):
-    sec = int(t)
-    cs = int((t - sec) * 100)
-    m = sec // 60
-    sec = sec % 60
-
-    return "0:%02d:%02d.%02d" % (m, sec, cs)
-
-for compound in s.compounds:
-
-    count = compound.steps
-
-    for tag in compound:
-        if tag not in tags:
-            continue
-        v = compound[tag]
-
-        offset = -0.22
-        headstart = 60/180 * 1/2
-
-        msec = headstart * 100
-
-        line = "{\k%d}" % int(round(msec))
-        #line = ""
-
-        step = 0
-        for atom in v.atoms:
-            lm = int(round(msec))
-            xs, xe = compound.get_atom_time(step, atom.steps)
-            xe += offset
-            xs += offset
-            msec += (xe - xs) * 100
-            line += "{\k%d}" % (int(round(msec)) - lm)
-            step += atom.steps
-            line += atom.text
-        
-        st, et = compound.get_atom_time(0, step)
-        st += offset
-        et += offset
-        print("Dialogue: 0,%s,%s,Default,,0,0,0,,%s" %
-            (ft(st - headstart), ft(et), line)) 
+if not opts.batch:
+    if len(opts.songpath) != 1:
+        parser.error("exporting multiple songs requires --batch")
+    s = song.Song(opts.songpath[0])
+    variant = list(s.variants.keys())[opts.variant]
+    lyric_export.ASSWriter().write(sys.stdout, s, variant, lyric_export.build_table(s, variant))
+    sys.exit(0)
+
+writer = lyric_export.ASSWriter()
+
+def output_base(songpath, root):
+    base = os.path.splitext(songpath)[0]
+    if opts.output_dir is None:
+        return base
+    return os.path.join(opts.output_dir, os.path.relpath(base, root))
+
+def manifest_path(outbase):
+    return "%s.%s-export.json" % (outbase, writer.ext)
+
+def up_to_date(songpath, outbase):
+    # Variant names are only known after parsing the song, so the outputs of
+    # the last run (and the tags they were filtered by) are kept alongside
+    if opts.force:
+        return False
+    try:
+        with open(manifest_path(outbase)) as fd:
+            manifest = json.load(fd)
+        if manifest["tags"] != sorted(opts.tag or []):
+            return False
+        mtime = os.stat(songpath).st_mtime
+        paths = [manifest_path(outbase)] + [os.path.join(os.path.dirname(outbase), i)
+                                            for i in manifest["outputs"]]
+        return all(os.stat(i).st_mtime >= mtime for i in paths)
+    except (OSError, ValueError, KeyError):
+        return False
+
+def export(job):
+    songpath, root = job
+    outbase = output_base(songpath, root)
+    try:
+        if up_to_date(songpath, outbase):
+            return songpath, "skipped", None
+        s = song.Song(songpath)
+        variants = [k for k, v in s.variants.items()
+                    if not opts.tag or set(opts.tag) & set(v.tag_list)]
+        os.makedirs(os.path.dirname(outbase) or ".", exist_ok=True)
+        outputs = []
+        if variants:
+            outputs = lyric_export.export_song(s, outbase, [writer], variants)
+        with open(manifest_path(outbase), "w") as fd:
+            json.dump({"tags": sorted(opts.tag or []),
+                       "outputs": [os.path.basename(i) for i in outputs]}, fd)
+        if not variants:
+            return songpath, "unmatched", None
+        return songpath, "ok", outputs
+    except Exception as e:
+        return songpath, "error", "%s: %s" % (type(e).__name__, e)
+
+jobs = []
+for path in opts.songpath:
+    root = path if os.path.isdir(path) else os.path.dirname(path)
+    for songpath in library.find_songs([path]):
+        jobs.append((songpath, root))
+
+counts = {"ok": 0, "skipped": 0, "unmatched": 0, "error": 0}
+with multiprocessing.Pool(max(1, opts.jobs)) as pool:
+    for songpath, status, info in pool.imap_unordered(export, jobs, chunksize=4):
+        counts[status] += 1
+        if status == "ok":
+            for path in info:
+                print(path)
+        elif status == "error":
+            print("FAIL %s: %s" % (songpath, info), file=sys.stderr)
+
+print("%d exported, %d up to date, %d without matching variants, %d failed" % (
+    counts["ok"], counts["skipped"], counts["unmatched"], counts["error"]), file=sys.stderr)
+sys.exit(1 if counts["error"] else 0)
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2020 Hector Martin "marcan" <marcan@marcan.st>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+
+from blitzloop import song, util
+
+import lyric_export
+
+parser = util.get_argparser()
+parser.add_argument(
+    'songpath', metavar='SONGPATH', help='path to the song file')
+parser.add_argument(
+    '--output', metavar='BASE',
+    help='output path prefix, files are named BASE.VARIANT.EXT (default: song path without extension)')
+parser.add_argument(
+    '--format', default='ass,lrc,vtt',
+    help='comma-separated list of formats (%s), or "all"' % ",".join(sorted(lyric_export.WRITERS)))
+parser.add_argument(
+    '--variant', type=int, action='append', help='song variant (default: all variants)')
+parser.add_argument(
+    '--pathbase', default="", help='file path base (Joysound projects)')
+opts = util.get_opts()
+
+# Only used if Joysound projects are requested
+opts.display = "surfaceless"
+
+if opts.format == "all":
+    formats = sorted(lyric_export.WRITERS)
+else:
+    formats = opts.format.split(",")
+    for fmt in formats:
+        if fmt not in lyric_export.WRITERS:
+            parser.error("unknown format %r" % fmt)
+
+writers = []
+for fmt in formats:
+    if fmt == "joysound":
+        writers.append(lyric_export.JoysoundWriter(opts.pathbase))
+    else:
+        writers.append(lyric_export.WRITERS[fmt]())
+
+s = song.Song(opts.songpath)
+
+variants = None
+if opts.variant:
+    keys = list(s.variants.keys())
+    variants = [keys[i] for i in opts.variant]
+
+outbase = opts.output or os.path.splitext(opts.songpath)[0]
+for path in lyric_export.export_song(s, outbase, writers, variants):
+    print(path)
+
+if "joysound" in formats:
+    # The GL display may keep threads around, see export_joysound_prj.py
+    os._exit(0)
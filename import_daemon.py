@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+import os, time, struct, select, signal, shutil, argparse, traceback
+import ctypes, ctypes.util
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import profiling
+
+# Spool layout: new files are dropped into the spool directory itself (as
+# dotfiles while being written, or written elsewhere and renamed in), and
+# are renamed into these subdirectories as they go through the daemon.
+# Renames within one filesystem are atomic, so a file is claimed by exactly
+# one daemon, and is never in two states at once.
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+# Files not known to be complete (no close-after-write seen) must have
+# kept the same size and mtime for this long
+SETTLE_TIME = 2.0
+# With inotify, rescan the spool this often anyway, in case events were lost
+RESCAN_INTERVAL = 60.0
+
+class Inotify(object):
+    """Minimal inotify binding, watching one directory for files that
+    were closed after writing or moved in."""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        # Raises AttributeError where there is no inotify
+        init1 = libc.inotify_init1
+        self.fd = init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                  self.IN_CLOSE_WRITE | self.IN_MOVED_TO) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed for %s" % path)
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for events. Returns the names of the
+        files that are complete, or None if events were lost."""
+        names = set()
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return names
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return names
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = self.EVENT.unpack_from(buf, pos)
+                pos += self.EVENT.size
+                if mask & self.IN_Q_OVERFLOW:
+                    return None
+                names.add(os.fsdecode(buf[pos:pos + length].rstrip(b"\0")))
+                pos += length
+
+    def close(self):
+        os.close(self.fd)
+
+class Poller(object):
+    """Fallback for Inotify: nothing is known to be complete, so every file
+    has to settle."""
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return set()
+
+    def close(self):
+        pass
+
+def move_unique(src, dstdir):
+    """Rename src into dstdir, adding a suffix if the name is taken."""
+    name = os.path.basename(src)
+    dst = os.path.join(dstdir, name)
+    i = 1
+    while os.path.exists(dst):
+        dst = os.path.join(dstdir, "%s.%d" % (name, i))
+        i += 1
+    os.rename(src, dst)
+    return dst
+
+def reserve_dir(root, name):
+    """Create an empty directory root/name, adding a suffix if the name is
+    taken. mkdir is atomic, so concurrent jobs never get the same one."""
+    path = os.path.join(root, name)
+    i = 1
+    while True:
+        try:
+            os.mkdir(path)
+            return path
+        except FileExistsError:
+            path = os.path.join(root, "%s.%d" % (name, i))
+            i += 1
+
+def warm_worker():
+    # Load blitzloop, construct and the format schemas once per worker
+    import import_ujk, import_joy02
+    import ujk_format, joy02_format
+    ujk_format.UJKFile, joy02_format.Joy02File
+    # Stopping is up to the daemon, which lets running imports finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def nop():
+    pass
+
+def import_job(path, destroot, stems, gain, profile):
+    """Import one claimed file, by its magic, into a new song directory
+    named after it. Returns None, or the traceback of the failure."""
+    import import_ujk, import_joy02
+    # Songs are imported into a hidden directory and only renamed into
+    # place once complete, so a failed import leaves nothing behind and a
+    # library scan never sees half a song
+    name = os.path.splitext(os.path.basename(path))[0]
+    tmpdir = reserve_dir(destroot, ".%s.tmp" % name)
+    prof = profiling.StageProfiler() if profile else None
+    profiling.set_profiler(prof)
+    try:
+        with open(path, "rb") as fd:
+            magic = fd.read(6)
+        if magic.startswith(b"UJK1"):
+            import_ujk.import_file(path, tmpdir, stems=stems, gain=gain)
+        elif magic == b"JOY-02":
+            import_joy02.import_file(path, os.path.join(tmpdir, "song.blitz"))
+        else:
+            raise Exception("Not a UJK or JOY-02 file")
+        if prof:
+            prof.write_report(os.path.join(tmpdir, "import_profile.json"), file=path)
+        # Songs with the same file name (say, two song.ujk) get a suffix;
+        # the rename replaces the empty directory reserved for it
+        os.rename(tmpdir, reserve_dir(destroot, name))
+        return None
+    except Exception:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        return traceback.format_exc()
+    finally:
+        profiling.set_profiler(None)
+
+class Daemon(object):
+    def __init__(self, opts):
+        self.opts = opts
+        self.spool = opts.spooldir
+        for d in (PROCESSING, DONE, FAILED):
+            os.makedirs(os.path.join(self.spool, d), exist_ok=True)
+        self.pool = None
+        # Future -> (claimed path, pool running it)
+        self.jobs = {}
+        self.limit = opts.jobs + opts.queue_size
+        # name -> (size, mtime_ns, time first seen like that)
+        self.seen = {}
+        self.stopping = False
+
+    def log(self, msg):
+        print("[%s] %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), msg), flush=True)
+
+    def start_pool(self):
+        self.pool = ProcessPoolExecutor(self.opts.jobs, initializer=warm_worker)
+        # Workers are started on demand; get them all up front, so that
+        # the first files don't wait for imports (and a broken install
+        # fails right away)
+        for f in [self.pool.submit(nop) for i in range(self.opts.jobs)]:
+            f.result()
+
+    def recover(self):
+        # Files left in processing by a daemon that died are retried
+        pdir = os.path.join(self.spool, PROCESSING)
+        for name in os.listdir(pdir):
+            self.log("Retrying %s" % name)
+            move_unique(os.path.join(pdir, name), self.spool)
+
+    def candidates(self, complete):
+        """Files in the spool that are ready to import, oldest first."""
+        now = time.monotonic()
+        ready = []
+        present = set()
+        for entry in os.scandir(self.spool):
+            if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                continue
+            present.add(entry.name)
+            st = entry.stat(follow_symlinks=False)
+            key = (st.st_size, st.st_mtime_ns)
+            if entry.name in complete:
+                ready.append((st.st_mtime_ns, entry.name))
+                continue
+            prev = self.seen.get(entry.name)
+            if prev is None or prev[:2] != key:
+                self.seen[entry.name] = key + (now,)
+            elif now - prev[2] >= SETTLE_TIME:
+                ready.append((st.st_mtime_ns, entry.name))
+        for name in list(self.seen):
+            if name not in present:
+                del self.seen[name]
+        return [name for mtime, name in sorted(ready)]
+
+    def claim(self, name):
+        src = os.path.join(self.spool, name)
+        dst = os.path.join(self.spool, PROCESSING, name)
+        if os.path.exists(dst):
+            return None
+        try:
+            os.rename(src, dst)
+        except FileNotFoundError:
+            # Taken by someone else
+            return None
+        self.seen.pop(name, None)
+        return dst
+
+    def submit(self, path):
+        opts = self.opts
+        fut = self.pool.submit(import_job, path, opts.destdir, opts.stems, opts.gain, opts.profile)
+        self.jobs[fut] = path, self.pool
+        self.log("Queued %s (%d in flight)" % (os.path.basename(path), len(self.jobs)))
+
+    def reap(self):
+        broken = False
+        for fut in [f for f in self.jobs if f.done()]:
+            path, pool = self.jobs.pop(fut)
+            try:
+                err = fut.result()
+            except BrokenProcessPool:
+                # There is no telling which job killed the worker, so all
+                # the ones it had fail with it
+                err = "Worker process died\n"
+                broken = broken or pool is self.pool
+            if err is None:
+                move_unique(path, os.path.join(self.spool, DONE))
+                self.log("Imported %s" % os.path.basename(path))
+            else:
+                dst = move_unique(path, os.path.join(self.spool, FAILED))
+                with open(dst + ".log", "w") as fd:
+                    fd.write(err)
+                self.log("Failed %s:\n%s" % (os.path.basename(path), err.rstrip()))
+        if broken:
+            self.pool.shutdown(wait=False)
+            self.start_pool()
+
+    def stop(self, signum, frame):
+        self.log("Stopping after %d jobs in flight" % len(self.jobs))
+        self.stopping = True
+
+    def run(self):
+        self.recover()
+        self.start_pool()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        watcher = None
+        if not self.opts.poll:
+            try:
+                watcher = Inotify(self.spool)
+                self.log("Watching %s with inotify" % self.spool)
+            except (AttributeError, OSError) as e:
+                self.log("inotify unavailable (%s), polling" % e)
+        if watcher is None:
+            watcher = Poller(self.opts.poll_interval)
+            self.log("Polling %s every %gs" % (self.spool, self.opts.poll_interval))
+
+        complete = set()
+        rescan = True
+        last_scan = 0
+        try:
+            while not self.stopping or self.jobs:
+                self.reap()
+                if not self.stopping and (rescan or complete or self.seen or
+                                          time.monotonic() - last_scan > RESCAN_INTERVAL):
+                    last_scan = time.monotonic()
+                    # Once the queue is full, files stay in the spool (and
+                    # complete) until there is room
+                    for name in self.candidates(complete):
+                        if len(self.jobs) >= self.limit:
+                            break
+                        complete.discard(name)
+                        path = self.claim(name)
+                        if path:
+                            self.submit(path)
+                    complete &= set(os.listdir(self.spool))
+                    rescan = False
+
+                # Wake up for job completions and settling files, and
+                # every second anyway to notice stop() (waits are resumed
+                # after signal handlers run)
+                names = watcher.wait(0.5 if self.jobs or self.seen else 1.0)
+                if names is None:
+                    rescan = True
+                else:
+                    complete |= names
+                    rescan = bool(names) or isinstance(watcher, Poller)
+        finally:
+            watcher.close()
+            self.pool.shutdown()
+        self.log("Stopped")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import UJK and JOY-02 files dropped into a spool directory")
+    parser.add_argument("spooldir", metavar="SPOOLDIR",
+                        help="directory to watch; processing/, done/ and failed/ are created in it")
+    parser.add_argument("destdir", metavar="DESTDIR",
+                        help="song directory to import into (one subdirectory per file)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="worker processes (default: number of CPUs)")
+    parser.add_argument("-q", "--queue-size", type=int, default=4,
+                        help="files claimed ahead of free workers; the rest wait in the spool")
+    parser.add_argument("--poll", action="store_true",
+                        help="poll the spool directory instead of using inotify")
+    parser.add_argument("--poll-interval", type=float, default=2.0,
+                        help="seconds between polls (default: 2)")
+    parser.add_argument("--stems", action="store_true",
+                        help="encode UJK audio as stems, see import_ujk.py")
+    parser.add_argument("--no-gain", dest="gain", action="store_false",
+                        help="don't measure track gain while encoding")
+    parser.add_argument("--profile", action="store_true",
+                        help="write an import_profile.json stage report into each song directory")
+    opts = parser.parse_args()
+
+    os.makedirs(opts.destdir, exist_ok=True)
+    Daemon(opts).run()
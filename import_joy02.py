@@ -1,10 +1,11 @@
 #!/usr/bin/env python3
 # -!- coding: utf-8 -!-
 
-import sys
+import argparse
 from blitzloop.song import Song, Variant, Style, OrderedDict, JapaneseMolecule, MultiString, MixedFraction, Compound
 from decimal import Decimal
 from joy02_format import Joy02File
+import profiling
 
 def is_furiganable(char):
     if char in " 　？！?!…。、.,-「」―-":
@@ -35,10 +36,20 @@ class Joy02Importer(object):
         self.metadata = metadata
 
     def import_all(self):
-        self.import_meta()
-        self.import_lyrics()
-        self.import_styles()
-        self.import_timing()
+        blocks = self.lyrics.blocks
+        profiling.count("blocks", len(blocks))
+        profiling.count("chars", sum(len(b.chars) for b in blocks))
+        profiling.count("furi", sum(len(b.furi) for b in blocks))
+        profiling.count("events", len(self.timing))
+
+        with profiling.stage("meta"):
+            self.import_meta()
+        with profiling.stage("lyrics"):
+            self.import_lyrics()
+        with profiling.stage("styles"):
+            self.import_styles()
+        with profiling.stage("timing"):
+            self.import_timing()
 
     def import_meta(self):
         self.song.meta["title"] = MultiString([
@@ -281,16 +292,41 @@ class Joy02Importer(object):
                 assert 0 == len(compound.timing)
             self.song.compounds.append(compound)
 
-if __name__ == "__main__":
-    with open(sys.argv[1], "rb") as fd:
-        js = Joy02File.parse(fd.read())
+def import_file(path, output):
+    """Convert the JOY-02 file at path into the song file output."""
+    with profiling.stage("read"):
+        with open(path, "rb") as fd:
+            data = fd.read()
+    with profiling.stage("parse"):
+        js = Joy02File.parse(data)
 
     song = Song()
     song.timing.add(0, 0)
     song.timing.add(1, 1)
 
-    importer = Joy02Importer(song, js.lyrics, js.timing, js.metadata)
-    importer.import_all()
+    with profiling.stage("import"):
+        importer = Joy02Importer(song, js.lyrics, js.timing, js.metadata)
+        importer.import_all()
+
+    with profiling.stage("dump"):
+        with open(output, "wb") as fd:
+            fd.write(song.dump().encode("utf-8"))
 
-    with open(sys.argv[2], "wb") as fd:
-        fd.write(song.dump().encode("utf-8"))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert a JOY-02 file into a BlitzLoop song file")
+    parser.add_argument("joy02", metavar="JOY02FILE", help="JOY-02 file to import")
+    parser.add_argument("output", metavar="OUTPUT", help="song file to write")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="record the time and memory used by each stage and write a JSON report")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="with --profile, also trace allocations for each stage's peak (slow)")
+    opts = parser.parse_args()
+
+    if opts.profile:
+        prof = profiling.StageProfiler(memory=opts.profile_memory)
+        profiling.set_profiler(prof)
+
+    import_file(opts.joy02, opts.output)
+
+    if opts.profile:
+        prof.print_report(prof.write_report(opts.profile, file=opts.joy02))
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 # -!- coding: utf-8 -!-
 
-import sys, os, subprocess
+import sys, os, subprocess, argparse
+from concurrent.futures import ThreadPoolExecutor
 from blitzloop.song import Song, Variant, Style, OrderedDict, JapaneseMolecule, MultiString, MixedFraction, Compound
 from decimal import Decimal
 from ujk_format import UJKFile
 from import_joy02 import Joy02Importer
+import loudness
+import media_utils
+import ogg_opus
+import profiling
 
 def get_bitmap(char):
     PAL = " .,-+*iotwITW&#@"[::-1]
@@ -107,32 +112,9 @@ FULLWIDTH_TO_HALFWIDTH = {
 for i in range(0x21, 0x7f):
     FULLWIDTH_TO_HALFWIDTH[i + 0xfee0] = i
 
-if __name__ == "__main__":
-    with open(sys.argv[1], "rb") as fd:
-        ujk = UJKFile.parse(fd.read())
-
-    destdir = sys.argv[2]
-
-    if not os.path.exists(destdir):
-        os.mkdir(destdir)
-
-    song = Song()
-    # Lol timing is off in the source files
-    song.timing.add(0.2, 0)
-    song.timing.add(1.2, 1)
-
-    meta = ujk.lyrics.value.metadata
-    meta.title = meta.title.translate(FULLWIDTH_TO_HALFWIDTH)
-    meta.artist = meta.artist.translate(FULLWIDTH_TO_HALFWIDTH)
-    meta.writer = meta.writer.translate(FULLWIDTH_TO_HALFWIDTH)
-    meta.composer = meta.composer.translate(FULLWIDTH_TO_HALFWIDTH)
-
-    importer = JoyU2Importer(ujk, song)
-    importer.import_all()
-
-    with open(os.path.join(destdir, "title_card.png"), "wb") as fd:
-        fd.write(ujk.title_card)
-
+def get_streams(ujk):
+    """Reassemble the interleaved audio blocks into one AAC stream per
+    track."""
     streams = []
 
     for i, hdr in enumerate(ujk.audio.headers):
@@ -142,41 +124,197 @@ if __name__ == "__main__":
     for block in ujk.audio.blocks:
         streams[block.stream_id].append(block.data)
 
-    streams = [b"".join(l) for l in streams]
-
-    print("Merging audio...")
-
-    cmd = [
-        "ffmpeg", "-loglevel", "error", "-y"
-    ]
+    return [b"".join(l) for l in streams]
 
+def write_streams(streams, destdir):
+    paths = []
     for i, data in enumerate(streams):
         path = os.path.join(destdir, "stream%d.aac" % i)
         with open(path, "wb") as fd:
             fd.write(data)
-        cmd += ["-i", path]
+        paths.append(path)
+    return paths
 
-    filters = ["[%d]apad[p%d]" % (i, i) for i in range(1, len(streams))]
+def merge_graph(paths):
+    """ffmpeg input arguments and filters merging all streams into [aout],
+    with the extra tracks padded to the length of the first one."""
+    args = []
+    for path in paths:
+        args += ["-i", path]
+
+    filters = ["[%d]apad[p%d]" % (i, i) for i in range(1, len(paths))]
     filters.append("[0]" +
-                   "".join("[p%d]" % i for i in range(1, len(streams))) +
-                   ("amerge=inputs=%d[aout]" % len(streams)))
+                   "".join("[p%d]" % i for i in range(1, len(paths))) +
+                   ("amerge=inputs=%d[aout]" % len(paths)))
+    return args, filters
+
+def merge_audio(paths, output, mixes=None):
+    """Encode all streams into one multichannel Opus stream. With mixes
+    (from loudness.song_mixes()), the merged PCM is also fed to the
+    loudness analysis as it is encoded, and its results returned."""
+    args, filters = merge_graph(paths)
+    cmd = [
+        "ffmpeg", "-loglevel", "error", "-y"
+    ] + args
 
+    if not mixes:
+        cmd += [
+            "-filter_complex", ";".join(filters),
+            "-map", "[aout]", output
+        ]
+        subprocess.run(cmd, check=True, stdin=subprocess.PIPE)
+        return None
+
+    channels = 2 * len(paths)
+    filters.append("[aout]asplit=2[enc][pcm]")
     cmd += [
         "-filter_complex", ";".join(filters),
-        "-map", "[aout]", os.path.join(destdir, "audio.opus")
-    ]
+        "-map", "[enc]", output,
+        "-map", "[pcm]"
+    ] + loudness.decoder_args(channels) + ["-"]
+    return loudness.analyze_command(cmd, channels, mixes)
 
+def analyze_streams(paths, mixes):
+    args, filters = merge_graph(paths)
+    channels = 2 * len(paths)
+    cmd = [
+        "ffmpeg", "-loglevel", "error",
+    ] + args + [
+        "-filter_complex", ";".join(filters),
+        "-map", "[aout]"
+    ] + loudness.decoder_args(channels) + ["-"]
+    return loudness.analyze_command(cmd, channels, mixes)
+
+def encode_stem(input_args, output):
+    # All stems must come out with the same frame size and pre-skip to be
+    # merged, so they all get the same encoder settings
+    cmd = [
+        "ffmpeg", "-loglevel", "error", "-y"
+    ] + input_args + [
+        "-ac", "2", "-c:a", "libopus", output
+    ]
     subprocess.run(cmd, check=True, stdin=subprocess.PIPE)
 
-    song.song["audio"] = "audio.opus"
+def encode_stems(paths, output, jobs=None, mixes=None):
+    """Encode each stream as stereo Opus on its own ffmpeg process, all at
+    once, then merge the encoded streams into one multichannel Opus stream
+    without re-encoding (see ogg_opus.py). The result has the same channels
+    as merge_audio()'s, with the extra tracks padded with encoded silence to
+    the length of the first one. With mixes, the loudness of the merged
+    streams is analyzed alongside the encoders and returned."""
+    base = os.path.splitext(output)[0]
+    stems = ["%s.stem%d.opus" % (base, i) for i in range(len(paths))]
+    silence = base + ".silence.opus"
+    inputs = [["-i", p] for p in paths]
+    inputs.append(["-f", "lavfi", "-i", "anullsrc=r=48000:cl=stereo", "-t", "1"])
+    workers = (jobs or len(paths)) + (1 if mixes else 0)
+    try:
+        with ThreadPoolExecutor(workers) as ex:
+            analysis = ex.submit(analyze_streams, paths, mixes) if mixes else None
+            for f in [ex.submit(encode_stem, i, s) for i, s in zip(inputs, stems + [silence])]:
+                f.result()
+            res = analysis.result() if analysis else None
+
+        # A packet from the middle, clear of the encoder's start and end
+        packets, granule = ogg_opus.read_packets(silence)
+        ogg_opus.merge_streams(stems, output, packets[len(packets) // 2])
+    finally:
+        for stem in stems + [silence]:
+            if os.path.exists(stem):
+                os.unlink(stem)
+    return res
+
+def import_file(path, destdir, stems=False, jobs=None, gain=True):
+    """Import the UJK file at path into the song directory destdir. See
+    the command line options for stems, jobs and gain."""
+    with profiling.stage("read"):
+        with open(path, "rb") as fd:
+            data = fd.read()
+    with profiling.stage("parse"):
+        ujk = UJKFile.parse(data)
+
+    if not os.path.exists(destdir):
+        os.mkdir(destdir)
+
+    song = Song()
+    # Lol timing is off in the source files
+    song.timing.add(0.2, 0)
+    song.timing.add(1.2, 1)
+
+    meta = ujk.lyrics.value.metadata
+    meta.title = meta.title.translate(FULLWIDTH_TO_HALFWIDTH)
+    meta.artist = meta.artist.translate(FULLWIDTH_TO_HALFWIDTH)
+    meta.writer = meta.writer.translate(FULLWIDTH_TO_HALFWIDTH)
+    meta.composer = meta.composer.translate(FULLWIDTH_TO_HALFWIDTH)
+
+    with profiling.stage("import"):
+        importer = JoyU2Importer(ujk, song)
+        importer.import_all()
+
+    with open(os.path.join(destdir, "title_card.png"), "wb") as fd:
+        fd.write(ujk.title_card)
+
+    with profiling.stage("streams"):
+        streams = get_streams(ujk)
+        paths = write_streams(streams, destdir)
+    mixes = loudness.song_mixes(len(streams) - 1)[1] if gain else None
+
+    audio = "audio.opus"
+    with profiling.stage("audio"):
+        if stems:
+            print("Encoding %d stems..." % len(streams))
+            gains = encode_stems(paths, os.path.join(destdir, audio), jobs, mixes)
+        else:
+            print("Merging audio...")
+            gains = merge_audio(paths, os.path.join(destdir, audio), mixes)
+
+    song.song["audio"] = audio
     song.song["fade_in"] = "0"
     song.song["fade_out"] = "0"
     song.song["volume"] = 1.0
     song.song["channels"] = len(streams) - 1
     song.song["channel_names"] = ",".join(NAMES[:len(streams) - 1])
     song.song["channel_defaults"] = ",".join((["10"] + ["5"] + ["10"] * len(streams))[:len(streams) - 1])
+    if gains:
+        # Same keys as apply_replaygain.py, which will then skip this song
+        if gains["track"] is None:
+            print("Warning: the mix is silent or too short to measure, track gain not set")
+            song.song[loudness.UNMEASURED_KEY] = "track"
+        else:
+            gain, peak = gains["track"]
+            print("track_gain = %.04f, track_peak = %.04f" % (gain, peak))
+            song.song["track_gain"] = "%.06f" % gain
+            song.song["track_peak"] = "%.06f" % peak
+        with profiling.stage("fingerprint"):
+            song.song["track_gain_source"] = media_utils.fingerprint(os.path.join(destdir, audio), destdir)
 
-    with open(os.path.join(destdir, "song.blitz"), "wb") as fd:
-        fd.write(song.dump().encode("utf-8"))
+    with profiling.stage("dump"):
+        with open(os.path.join(destdir, "song.blitz"), "wb") as fd:
+            fd.write(song.dump().encode("utf-8"))
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import a UJK file into a BlitzLoop song directory")
+    parser.add_argument("ujk", metavar="UJKFILE", help="UJK file to import")
+    parser.add_argument("destdir", metavar="DESTDIR", help="song directory to create")
+    parser.add_argument("--stems", action="store_true",
+                        help="encode each stream separately and in parallel, and merge "
+                        "the encoded streams into the multichannel audio.opus")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="concurrent encoders with --stems (default: one per stream)")
+    parser.add_argument("--no-gain", dest="gain", action="store_false",
+                        help="don't measure the track gain and peak while encoding")
+    parser.add_argument("--profile", metavar="REPORT",
+                        help="record the time and memory used by each stage and write a JSON report")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="with --profile, also trace allocations for each stage's peak (slow)")
+    opts = parser.parse_args()
+
+    if opts.profile:
+        prof = profiling.StageProfiler(memory=opts.profile_memory)
+        profiling.set_profiler(prof)
+
+    import_file(opts.ujk, opts.destdir, opts.stems, opts.jobs, opts.gain)
     print("Done.")
+
+    if opts.profile:
+        prof.print_report(prof.write_report(opts.profile, file=opts.ujk))
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2019 Hector Martin "marcan" <hector@marcansoft.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import unicodedata
+
+import xml.etree.ElementTree as ET
+
+from blitzloop import graphics, layout, song
+
+import layout_cache
+import media_utils
+
+# We need a virtual screen for line layout, just use something
+WIDTH = 720
+HEIGHT = 480
+
+class XMLWriter(object):
+    """Incremental XML writer producing the same indented CRLF layout the
+    Joysound tools use (and that minidom's toprettyxml() would)."""
+
+    ESCAPES = [("&", "&amp;"), ("<", "&lt;"), ("\"", "&quot;"), (">", "&gt;")]
+
+    def __init__(self, fd, indent="  ", newl="\r\n", encoding="UTF-8"):
+        self.fd = fd
+        self.indent = indent
+        self.newl = newl
+        self.encoding = encoding
+        self.stack = []
+        # Whether the innermost open tag still needs its '>'
+        self.pending = False
+        self._write('<?xml version="1.0" encoding="%s"?>%s' % (encoding, newl))
+
+    def _write(self, s):
+        self.fd.write(s.encode(self.encoding))
+
+    def _escape(self, text):
+        text = text.replace("\n", " ").replace("\r", "")
+        for a, b in self.ESCAPES:
+            text = text.replace(a, b)
+        return text
+
+    def _open_parent(self):
+        if self.pending:
+            self._write(">" + self.newl)
+            self.pending = False
+
+    def start(self, tag):
+        self._open_parent()
+        self._write(self.indent * len(self.stack) + "<" + tag)
+        self.stack.append(tag)
+        self.pending = True
+
+    def end(self):
+        tag = self.stack.pop()
+        if self.pending:
+            self._write("/>" + self.newl)
+            self.pending = False
+        else:
+            self._write(self.indent * len(self.stack) + "</%s>%s" % (tag, self.newl))
+
+    def element(self, el):
+        if len(el):
+            self.start(el.tag)
+            for child in el:
+                self.element(child)
+            self.end()
+        elif el.text:
+            self._open_parent()
+            self._write("%s<%s>%s</%s>%s" % (self.indent * len(self.stack), el.tag,
+                                             self._escape(el.text), el.tag, self.newl))
+        else:
+            self.start(el.tag)
+            self.end()
+
+class JoysoundProject(object):
+    def __init__(self, song, renderer, variant=0, pathbase="", verbose=True, layout_cache=True):
+        self.renderer = renderer
+        self.variant = variant
+        self.pathbase = pathbase
+        self.verbose = verbose
+        self.layout_cache = layout_cache
+        self.warnings = []
+
+        self.root = ET.XML("""
+            <kyokupro>
+                <version>3</version>
+                <app_version>0.2.4.1</app_version>
+                <music_info>
+                    <set>1</set>
+                </music_info>
+                <telop/>
+            </kyokupro>
+        """.replace("\n", "").replace(" ", ""))
+
+        if song:
+            self.load(song)
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    def _warn(self, msg, text):
+        self.warnings.append("%s: %s" % (msg, text))
+        self._log("  ^-- WARNING: " + msg)
+
+    def _tag(self, name, val):
+        e = ET.Element(name)
+        e.text = val
+        return e
+
+    def _load_music_info(self, song):
+        info = self.root.find("music_info")
+        telop = self.root.find("telop")
+
+        if "title" in song.meta:
+            info.append(self._tag("song_name", song.meta["title"][None]))
+            telop.append(self._tag("song_name", song.meta["title"][None]))
+            if "k" in song.meta["title"]:
+                info.append(self._tag("song_name_yomi", song.meta["title"]["k"]))
+        if "artist" in song.meta:
+            info.append(self._tag("artist_name", song.meta["artist"][None]))
+            telop.append(self._tag("artist_name", "♪ " + song.meta["artist"][None]))
+            if "k" in song.meta["artist"]:
+                info.append(self._tag("artist_name_yomi", song.meta["artist"]["k"]))
+        info.append(self._tag("original_artist_name", " "))
+        if "writer" in song.meta:
+            info.append(self._tag("lyricist_name", song.meta["writer"][None]))
+            telop.append(self._tag("lyricist_name", "作詞 " + song.meta["writer"][None]))
+        if "composer" in song.meta:
+            info.append(self._tag("composer_name", song.meta["composer"][None]))
+            telop.append(self._tag("composer_name", "作曲 " + song.meta["composer"][None]))
+        info.append(self._tag("cover_code", " "))
+
+    def _load_audio(self, song, tag, path, **extra):
+        el = ET.XML("""
+            <music>
+                <file_path/>
+                <md5_sum/>
+                <type>1</type>
+                <format>1</format>
+                <play_time/>
+                <adjust_time>0</adjust_time>
+                <vol>50</vol>
+                <balance>0</balance>
+                <reverb>0</reverb>
+            </music>
+        """.replace("\n", "").replace(" ", ""))
+        el.tag = tag
+        el.find("file_path").text = self.pathbase + path
+        h = self._md5(song, path)
+        el.find("md5_sum").text = h
+        el.find("play_time").text = "%d" % (int(self.duration))
+        for k,v in extra.items():
+            el.append(self._tag(k, v))
+        return el
+
+    def _load_video(self, song, path, **extra):
+        el = ET.XML("""
+            <movie>
+                <file_path/>
+                <md5_sum/>
+                <type>1</type>
+                <format>4</format>
+                <play_time/>
+                <begin_time>0</begin_time>
+                <end_time/>
+                <enable>1</enable>
+            </movie>
+        """.replace("\n", "").replace(" ", ""))
+        el.find("file_path").text = self.pathbase + path
+        h = self._md5(song, path)
+        el.find("md5_sum").text = h
+        el.find("play_time").text = "%d" % (int(self.duration))
+        el.find("end_time").text = "%d" % (int(self.duration))
+        for k,v in extra.items():
+            el.append(self._tag(k, v))
+        return el
+
+    def _md5(self, song, path):
+        return self.hashes[os.path.join(song.pathbase, path)]
+
+    def _load_resources(self, song):
+        paths = [song.song[k] for k in ("cover", "audio_instrumental", "audio_vocal", "audio", "video")
+                 if k in song.song]
+        self.hashes = media_utils.get_md5s([os.path.join(song.pathbase, i) for i in paths],
+                                           song.pathbase)
+
+        if "cover" in song.song:
+            picture = ET.Element("picture")
+            picture.append(self._tag("artist_file_path", self.pathbase + song.song["cover"]))
+            h = self._md5(song, song.song["cover"])
+            picture.append(self._tag("artist_md5_sum", h))
+            self.root.append(picture)
+        if "audio_instrumental" in song.song:
+            music = self._load_audio(song, "music", song.song["audio_instrumental"], enable="1")
+            music.insert(0, self._tag("set", "1"))
+            self.root.append(music)
+        if "audio_vocal" in song.song:
+            vocal = ET.Element("vocal")
+            vocal.append(self._tag("set", "1"))
+            vocal.append(self._load_audio(song, "song", song.song["audio_vocal"],
+                                          song_type="0", song_number="0", enable="1",  marker_count="0"))
+            self.root.append(vocal)
+        if "audio" in song.song:
+            mix = self._load_audio(song, "mix", song.song["audio"], enable="1")
+            mix.insert(0, self._tag("set", "1"))
+            self.root.append(mix)
+        if "video" in song.song:
+            back = ET.Element("back")
+            back.append(self._tag("set", "1"))
+            back.append(self._load_video(song, song.song["video"]))
+            self.root.append(back)
+
+    def _load_lyrics(self, s):
+        telop = self.root.find("telop")
+
+        variant = list(s.variants.keys())[self.variant]
+        if self.layout_cache:
+            lyt = layout_cache.get_layout(s, variant, self.renderer)
+        else:
+            lyt = layout.SongLayout(s, variant, self.renderer)
+
+        lines = lyt.lines[song.TagInfo.BOTTOM]
+
+        class Page(object):
+            pass
+
+        # Group lines into pages
+        pages = []
+        page = Page()
+        page.lines = {}
+        last = None
+        for l in lines:
+            if l.row in page.lines or (last and (l.row > last.row or l.start > last.end)):
+                pages.append(page)
+                page = Page()
+                page.lines = {}
+            page.lines[l.row] = l
+            last = l
+        pages.append(page)
+
+        # Compute page show/hide times
+        prev = None
+        pages2 = []
+        for page in pages:
+            lines = page.lines
+            page.start = min(l.start for l in lines.values())
+            page.min_start = min(l._start_t for l in lines.values())
+            page.end = max(l.end for l in lines.values())
+            page.min_end = max(l._end_t for l in lines.values())
+
+            if prev and page.start < prev.end:
+                page.start = min(page.min_start, prev.end)
+                if prev and page.start < prev.end:
+                    prev.end = max(prev.min_end, page.start)
+                    if prev and page.start < prev.end:
+                        li = " ".join(repr(v.molecules[0][0].text) for k,v in sorted(lines.items(), reverse=True))
+                        raise Exception("overlapping lines! %r" % (li))
+            prev = page
+            pages2.append(page)
+
+        self.pages = pages
+
+        self.root.remove(telop)
+        self.root.append(telop)
+
+        telop_edit_setting = ET.XML("""
+            <telop_edit_setting>
+                <music_volume>50</music_volume>
+                <vocal_volume>50</vocal_volume>
+            </telop_edit_setting>
+        """.replace("\n", "").replace(" ", ""))
+        self.root.append(telop_edit_setting)
+
+    def _page_elements(self):
+        def ms(i):
+            return str(int(round(i * 1000)))
+
+        def color(rgb):
+            r, g, b = rgb
+            return "%d" % (r | (g << 8) | (b << 16))
+
+        # Generate XML, one page at a time
+        for page in self.pages:
+            pe = ET.Element("page")
+            pe.append(self._tag("show_time", ms(page.start)))
+            pe.append(self._tag("hide_time", ms(page.end)))
+            pe.append(self._tag("paint_timing", "0"))
+            pe.append(self._tag("layout", "xing_0"))
+
+            t = page.min_start
+            styles = None
+            for i in range(max(page.lines.keys()), -1, -1):
+                le = ET.Element("line")
+                text = ""
+                if i not in page.lines:
+                    if styles:
+                        styles = [[styles[-1][0], 0, 0]]
+                    else:
+                        styles = [[page.lines.values()[0].molecules[0].style, 0, 0]]
+                    # dummy line
+                    w = ET.Element("word")
+                    w.append(self._tag("text", " "))
+                    w.append(self._tag("start_time", ms(t)))
+                    w.append(self._tag("end_time", ms(t)))
+                    le.append(w)
+                    text = " "
+                    width = cwidth = 0
+                    align = 0
+                else:
+                    line = page.lines[i]
+                    align = line.align
+                    ruby = []
+                    styles = []
+
+                    for idx, instance in enumerate(line.molecules):
+                        mol = instance.molecule
+                        step = 0
+                        start_pos = len(text)
+                        for atom in mol.atoms:
+                            start, end = instance.get_atom_time(step, atom.steps)
+                            t = max(t, end)
+                            step += atom.steps
+
+                            w = ET.Element("word")
+                            w.append(self._tag("text", atom.text))
+                            w.append(self._tag("start_time", ms(start)))
+                            w.append(self._tag("end_time", ms(end)))
+                            le.append(w)
+
+                            if atom.particles is not None:
+                                edge = len(atom.text)
+                                edge_l = 0
+                                if atom.particle_edge:
+                                    edge = atom.particle_edge
+                                if atom.particle_edge_l:
+                                    edge_l = atom.particle_edge_l
+                                rt = ""
+                                for i in atom.particles:
+                                    rt += i.text
+                                r = ET.Element("ruby")
+                                r.append(self._tag("text", rt))
+                                r.append(self._tag("start_pos", "%d" % (len(text) + edge_l)))
+                                r.append(self._tag("end_pos", "%d" % (len(text) + edge - 1)))
+                                ruby.append(r)
+
+                            text += atom.text
+                        if idx != (len(line.molecules) - 1):
+                            text += "　"
+                            w[0].text += "　"
+                        if styles and instance.style == styles[-1]:
+                            styles[-1][2] = len(text) - 1
+                        else:
+                            styles.append([instance.style, start_pos, len(text) - 1])
+
+                    for r in ruby:
+                        le.append(r)
+
+                    self._log(text)
+                    width = line.max_px - line.min_px
+                    cwidth = len(text)
+                    for i in text:
+                        ew = unicodedata.east_asian_width(i)
+                        if ew in ("F", "W", "A"):
+                            cwidth += 1
+
+                    if cwidth > 26:
+                        self._warn("Line likely too long", text)
+
+                for style, start, end in styles:
+                    e = ET.Element("color")
+                    e.append(self._tag("before_text_color", color(style.colors[0])))
+                    e.append(self._tag("after_text_color", color(style.colors_on[0])))
+                    e.append(self._tag("before_shadow_color", color(style.colors[1])))
+                    e.append(self._tag("after_shadow_color", color(style.colors_on[1])))
+                    e.append(self._tag("before_text_no_fill_color", color(style.colors[0])))
+                    e.append(self._tag("after_text_no_fill_color", color(style.colors_on[0])))
+                    e.append(self._tag("before_shadow_no_fill_color", color(style.colors[1])))
+                    e.append(self._tag("after_shadow_no_fill_color", color(style.colors_on[1])))
+                    e.append(self._tag("start_pos", "%d" % start))
+                    e.append(self._tag("end_pos", "%d" % end))
+                    e.append(self._tag("no_fill", "1" if style.colors == style.colors_on else "0"))
+                    le.append(e)
+
+                e = ET.Element("duet")
+                e.append(self._tag("mark", "0"))
+                e.append(self._tag("start_pos", "0"))
+                e.append(self._tag("end_pos", "%d" % (len(text) - 1)))
+                le.append(e)
+
+                e = ET.Element("offset")
+                w = 720
+                margin = 54
+                offset = margin + (w * (1 - width) - 2 * margin) * align
+                if offset < 0 or offset + w * width > w - margin:
+                    self._warn("Line too wide", text)
+                # 0 = default
+                # 1 = offset from default
+                # 2 = abs left side
+                e.append(self._tag("type", "2"))
+                e.append(self._tag("auto_pos", "0"))
+                e.append(self._tag("offset", "%d" % round(offset)))
+                le.append(e)
+
+                pe.append(le)
+
+            yield pe
+
+    def load(self, song):
+        duration = media_utils.song_duration(song)
+        self.duration = int(round(duration * 1000))
+
+        self._load_music_info(song)
+        self._load_resources(song)
+        self._load_lyrics(song)
+
+    def write(self, fd):
+        # The lyric pages are generated and written out one by one, the rest
+        # of the document is small and kept as a tree.
+        writer = XMLWriter(fd)
+        writer.start(self.root.tag)
+        for el in self.root:
+            if el.tag == "telop":
+                writer.start(el.tag)
+                for child in el:
+                    writer.element(child)
+                for page in self._page_elements():
+                    writer.element(page)
+                writer.end()
+            else:
+                writer.element(el)
+        writer.end()
+
+    def save(self, path):
+        # Pages are streamed out as they are generated, so don't leave a
+        # truncated project behind if that fails halfway
+        tmp = path + ".tmp"
+        try:
+            with open(tmp, "wb") as fd:
+                self.write(fd)
+            os.replace(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+def create_renderer():
+    display = graphics.Display(WIDTH, HEIGHT)
+    return graphics.get_renderer().KaraokeRenderer(display)
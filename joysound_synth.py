@@ -0,0 +1,322 @@
+import struct, random
+
+from construct import GreedyBytes
+from joysound_utils import LZSSAdapter, LZSS_EFFORT
+from ujk_format import XOR_PAD
+
+# Characters used for synthetic lyrics. Kana that combine with the previous
+# character (small kana, long vowel mark) are left out so that every
+# character is one beat.
+KANJI = "日本語歌手夢空海花風雪月星光心愛時間道春夏秋冬川山森雨声色音"
+KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわ"
+
+CHAR_WIDTH = 48
+FURI_WIDTH = 24
+BLOCK_X = 100
+# Scroll speed of the synthetic timing, in units of 10px/s
+SPEED = 20
+
+EV_SCROLL_START = 0
+EV_SCROLL_SETSPEED = 1
+EV_SHOW_BLOCKS = 6
+
+class SynthParams(object):
+    """Shape of a synthetic song."""
+
+    def __init__(self, blocks=100, chars=12, furi_density=0.3, events=2,
+                 glyphs=256, audio_blocks=200, audio_block_size=4096,
+                 streams=3, seed=0):
+        self.blocks = blocks
+        self.chars = chars
+        # Fraction of characters that are kanji with furigana
+        self.furi_density = furi_density
+        # Speed changes per block, on top of the scroll start event
+        self.events = events
+        self.glyphs = glyphs
+        self.audio_blocks = audio_blocks
+        self.audio_block_size = audio_block_size
+        self.streams = streams
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+def sjis16(c):
+    """A character as the 16-bit SJIS value JOY-02 files store."""
+    b = c.encode("sjis")
+    return b[0] if len(b) == 1 else (b[0] << 8) | b[1]
+
+def u2_code(c, furi=False):
+    """A kana or kanji as a JOY-U2 font glyph code (see JoyU2Importer.get_char)."""
+    o = ord(c)
+    if 0x3041 <= o <= 0x3093:
+        return o - 0x3040 + (0xa320 if furi else 0xa020)
+    return sjis16(c)
+
+def varint(n):
+    """Encode n like VarIntb: big-endian 7-bit groups."""
+    groups = [n & 0x7f]
+    n >>= 7
+    while n:
+        groups.append(0x80 | (n & 0x7f))
+        n >>= 7
+    return bytes(reversed(groups))
+
+def gen_lyrics(params):
+    """Random lyrics as a list of blocks, each a list of (char, reading)
+    with reading None for plain kana."""
+    rnd = random.Random(params.seed)
+    blocks = []
+    for i in range(params.blocks):
+        chars = []
+        for j in range(params.chars):
+            if rnd.random() < params.furi_density:
+                chars.append((rnd.choice(KANJI), "".join(rnd.choice(KANA) for k in range(rnd.randint(1, 3)))))
+            else:
+                chars.append((rnd.choice(KANA), None))
+        blocks.append(chars)
+    return blocks
+
+def layout_block(chars):
+    """Character x positions relative to the block, and furigana as
+    (x, reading) centered over their character (x is unsigned, so long
+    readings on the first character are shifted right)."""
+    xs = []
+    furi = []
+    x = 0
+    for c, reading in chars:
+        xs.append(x)
+        if reading:
+            furi.append((max(0, x + CHAR_WIDTH // 2 - FURI_WIDTH * len(reading) // 2), reading))
+        x += CHAR_WIDTH
+    return xs, furi
+
+def gen_timing(params, blocks):
+    """Timing events as (time in ms, payload bytes), sorted by time."""
+    events = []
+    t = 1000
+    for chars in blocks:
+        duration = len(chars) * CHAR_WIDTH * 1000 // (SPEED * 10)
+        events.append((t - 500, bytes([EV_SHOW_BLOCKS, 1])))
+        events.append((t, bytes([EV_SCROLL_START, SPEED])))
+        for i in range(params.events):
+            events.append((t + duration * (i + 1) // (params.events + 1),
+                           bytes([EV_SCROLL_SETSPEED, SPEED])))
+        t += duration + 1000
+    return events
+
+class Writer(object):
+    """Little helper for laying out binary files with back-patched offsets."""
+
+    def __init__(self, endian):
+        self.endian = endian
+        self.data = bytearray()
+
+    def tell(self):
+        return len(self.data)
+
+    def pack(self, fmt, *args):
+        self.data += struct.pack(self.endian + fmt, *args)
+
+    def raw(self, b):
+        self.data += b
+
+    def patch(self, pos, fmt, *args):
+        struct.pack_into(self.endian + fmt, self.data, pos, *args)
+
+METADATA_FIELDS = ["title", "artist", "writer", "composer",
+                   "title_kana", "artist_kana", "jasrac_code", "sample"]
+
+def gen_metadata(params):
+    return {
+        "title": "合成曲%d" % params.seed,
+        "artist": "テスト歌手",
+        "writer": "作詞者",
+        "composer": "作曲者",
+        "title_kana": "ごうせいきょく",
+        "artist_kana": "てすとかしゅ",
+        "jasrac_code": "000-0000-0",
+        "sample": "",
+    }
+
+def write_metadata(w, meta, extra=b""):
+    """Metadata block at the current position: type, subtype, string
+    offsets, extra fields, then the strings."""
+    start = w.tell()
+    w.pack("BB", 1, 0)
+    table = w.tell()
+    w.raw(b"\0\0" * len(METADATA_FIELDS))
+    w.raw(extra)
+    for i, field in enumerate(METADATA_FIELDS):
+        w.patch(table + 2 * i, "H", w.tell() - start)
+        w.raw(meta[field].encode("sjis") + b"\0")
+
+def build_joy02(params):
+    """A synthetic JOY-02 file, returned as bytes."""
+    blocks = gen_lyrics(params)
+    w = Writer("<")
+    w.raw(b"JOY-02")
+    hdr = w.tell()
+    w.pack("IIII", 0, 0, 0, 0)
+
+    off_metadata = w.tell()
+    # duration, vocal_tracks, rhythm_tracks
+    write_metadata(w, gen_metadata(params), struct.pack("<HII", 300, 1, 1))
+
+    off_lyrics = w.tell()
+    for i in range(15):
+        w.pack("H", (i * 2) << 10 | (31 - i * 2) << 5 | i)
+    for i, chars in enumerate(blocks):
+        xs, furi = layout_block(chars)
+        start = w.tell()
+        w.pack("HHHHBBBB", 0, 0, BLOCK_X, 300 + 60 * (i & 1), 1, 2, 3, 4)
+        w.pack("H", len(chars))
+        for x, (c, reading) in zip(xs, chars):
+            w.pack("BHH", 0, sjis16(c), CHAR_WIDTH)
+        w.pack("H", len(furi))
+        for x, reading in furi:
+            w.pack("HH", len(reading), x)
+            for c in reading:
+                w.pack("H", sjis16(c))
+        w.patch(start, "H", w.tell() - start)
+
+    off_timing = w.tell()
+    for t, payload in gen_timing(params, blocks):
+        w.pack("IB", t, len(payload))
+        w.raw(payload)
+
+    w.patch(hdr, "IIII", off_metadata, off_lyrics, off_timing, 0)
+    return bytes(w.data)
+
+def build_font(glyph_codes, base=0):
+    """A JOY-U2 font section with one 4bpp glyph per code. Furigana glyphs
+    (codes 0xa3xx) are half size. The section is parsed as a slice of the
+    font file, which keeps the file's offsets, so its offsets are relative
+    to the file: base is where the section goes in it."""
+    w = Writer(">")
+    w.pack("HHII", 0, 0, 0, 0)
+    offsets = []
+    for code in glyph_codes:
+        size = FURI_WIDTH if (code >> 8) == 0xa3 else CHAR_WIDTH
+        stride = (size + 1) // 2
+        offsets.append(base + w.tell())
+        w.raw(b"\0" * 8)
+        w.pack("HBBBBH", code, size, size, size, size, stride)
+        w.raw(b"\0" * 6)
+        data = bytes((i * 7 + code) & 0xff for i in range(stride * size))
+        w.data += struct.pack("<H", len(data))
+        w.raw(data)
+    table_off = w.tell()
+    for off in offsets:
+        w.pack("I", off)
+    w.patch(4, "II", base + table_off, 4 * len(offsets))
+    return bytes(w.data)
+
+def build_font_file(glyph_codes):
+    hdr_size = 24
+    fonts = []
+    pos = hdr_size
+    for i in range(3):
+        fonts.append(build_font(glyph_codes, pos))
+        pos += len(fonts[-1])
+    w = Writer(">")
+    w.pack("IIIIII", hdr_size, hdr_size + len(fonts[0]), hdr_size + len(fonts[0]) + len(fonts[1]),
+           *[len(f) for f in fonts])
+    w.raw(b"".join(fonts))
+    return bytes(w.data)
+
+def build_joyu2(params, blocks, glyphs):
+    """A synthetic JOY-U2 lyrics file with the same lyrics in all three
+    sizes, given the glyph index of each code."""
+    w = Writer(">")
+    w.raw(b"JOY-U2")
+    hdr = w.tell()
+    w.raw(b"\0" * 32)
+
+    off_metadata = w.tell()
+    write_metadata(w, gen_metadata(params))
+
+    lyrics = Writer(">")
+    for i in range(15):
+        lyrics.pack("H", (i * 2) << 10 | (31 - i * 2) << 5 | i)
+    for i, chars in enumerate(blocks):
+        xs, furi = layout_block(chars)
+        start = lyrics.tell()
+        lyrics.pack("HHHHBBBBHH", 0, 0, BLOCK_X, 300 + 60 * (i & 1), 1, 2, 3, 4, 0, 0)
+        lyrics.pack("H", len(chars))
+        for c, reading in chars:
+            lyrics.pack("BH", 0, glyphs[u2_code(c)])
+        lyrics.pack("H", len(furi))
+        for x, reading in furi:
+            lyrics.pack("HH", len(reading), x)
+            for c in reading:
+                lyrics.pack("H", glyphs[u2_code(c, True)])
+        lyrics.patch(start, "H", lyrics.tell() - start)
+
+    timing = bytearray()
+    last = 0
+    for t, payload in gen_timing(params, blocks):
+        timing += varint(t - last) + bytes([len(payload)]) + payload
+        last = t
+
+    offsets = []
+    for i in range(3):
+        offsets.append(w.tell())
+        w.raw(lyrics.data)
+        offsets.append(w.tell())
+        w.raw(timing)
+    offsets.append(w.tell())
+    w.patch(hdr, "IIIIIIII", off_metadata, *offsets)
+    return bytes(w.data)
+
+def build_audio(params):
+    rnd = random.Random(params.seed)
+    w = Writer(">")
+    w.raw(b"TPSA")
+    w.pack("III", 0, params.streams, 0)
+    for i in range(params.streams):
+        w.pack("IIIIIIII", 0, 0, i, 0, 48000, 2, 48000, 0)
+    for i in range(params.audio_blocks):
+        data = rnd.getrandbits(8 * params.audio_block_size).to_bytes(params.audio_block_size, "little")
+        w.data += struct.pack("<IIII", len(data), 0, 0, i % params.streams)
+        w.raw(data)
+    w.patch(4, "I", len(w.data))
+    return bytes(w.data)
+
+def build_ujk(params, effort=LZSS_EFFORT):
+    """A synthetic UJK file, returned as bytes. effort is passed on to the
+    LZSS compressor."""
+    blocks = gen_lyrics(params)
+
+    codes = set()
+    for chars in blocks:
+        for c, reading in chars:
+            codes.add(u2_code(c))
+            for r in reading or "":
+                codes.add(u2_code(r, True))
+    codes = sorted(codes)
+    # Pad the font with glyphs nothing uses, up to the requested size
+    filler = 0x889f
+    while len(codes) < params.glyphs:
+        if filler not in codes:
+            codes.append(filler)
+        filler += 1
+    glyphs = dict((code, i) for i, code in enumerate(codes))
+
+    title = b"\x89PNG\r\n\x1a\n" + bytes(1024)
+    lzss = LZSSAdapter(GreedyBytes, effort)
+    lyrics = lzss.build(build_joyu2(params, blocks, glyphs))
+    fonts = lzss.build(build_font_file(codes))
+    audio = build_audio(params)
+
+    hdr_size = 16
+    pos = hdr_size + len(XOR_PAD)
+    offsets = []
+    for section in (audio, title, lyrics, fonts):
+        offsets += [pos, len(section)]
+        pos += len(section)
+    table = struct.pack(">IIIIIIII", *offsets).ljust(len(XOR_PAD), b"\0")
+    table = bytes(a ^ b for a, b in zip(table, XOR_PAD))
+
+    return (b"UJK1" + struct.pack(">III", hdr_size, pos, 0) + table +
+            audio + title + lyrics + fonts)
@@ -1,7 +1,11 @@
-import construct, io
+import construct, io, os
+import ctypes
+from ctypes import c_int, c_long, c_char_p
 from construct import *
 from construct import singleton, stream_read, byte2int
 
+import profiling
+
 # SJIS works like UTF-8 for CString purposes
 construct.core.possiblestringencodings["sjis"] = 1
 
@@ -13,40 +17,181 @@ LZSSBlock = Struct(
     "data" / Bytes(lambda ctx: ctx.csize)
 )
 
+LZSS_WINDOW = 0x1000
+LZSS_START = 0xfee
+LZSS_MIN_MATCH = 3
+LZSS_MAX_MATCH = 18
+
+# Default compressor effort (see lzss_compress), and the match length at
+# which it stops looking for a longer one
+LZSS_EFFORT = 4
+LZSS_GOOD_MATCH = 8
+
+# Built by "make liblzss.so". Without it, the pure Python versions below
+# are used, which are about a hundred times slower.
+LZSS_LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "liblzss.so")
+
+_lzss_lib = None
+
+def _lzss_load():
+    global _lzss_lib
+    if _lzss_lib is None:
+        try:
+            lib = ctypes.CDLL(LZSS_LIBRARY)
+        except OSError:
+            lib = False
+        else:
+            lib.lzss_bound.argtypes = [c_long]
+            lib.lzss_bound.restype = c_long
+            lib.lzss_compress.argtypes = [c_char_p, c_long, c_char_p, c_int, c_int]
+            lib.lzss_compress.restype = c_long
+            lib.lzss_decompress.argtypes = [c_char_p, c_long, c_char_p, c_long]
+            lib.lzss_decompress.restype = c_long
+        _lzss_lib = lib
+    return _lzss_lib or None
+
+def lzss_implementation():
+    return "c" if _lzss_load() else "python"
+
+def lzss_compress(data, effort=LZSS_EFFORT, good_match=LZSS_GOOD_MATCH):
+    """Compress data into the LZSS stream LZSSAdapter decodes. effort is the
+    number of earlier occurrences of each 3-byte prefix that are tried when
+    looking for the longest match (1 is fastest, larger finds more), and
+    the search stops early once a match of good_match bytes is found."""
+    lib = _lzss_load()
+    if lib is None:
+        return lzss_compress_python(data, effort, good_match)
+    data = bytes(data)
+    out = ctypes.create_string_buffer(lib.lzss_bound(len(data)))
+    size = lib.lzss_compress(data, len(data), out, effort, good_match)
+    return out.raw[:size]
+
+def lzss_decompress(data, dsize):
+    """Decompress an LZSS stream into dsize bytes."""
+    lib = _lzss_load()
+    if lib is None:
+        return lzss_decompress_python(data, dsize)
+    data = bytes(data)
+    out = ctypes.create_string_buffer(dsize)
+    if lib.lzss_decompress(data, len(data), out, dsize) < 0:
+        raise Exception("LZSS data ends before %d bytes were decompressed" % dsize)
+    return out.raw
+
+def lzss_compress_python(data, effort=LZSS_EFFORT, good_match=LZSS_GOOD_MATCH):
+    data = bytes(data)
+    n = len(data)
+    out = bytearray()
+    # Hash chains: head maps a 3-byte prefix to the last position it was
+    # seen at, prev links each position to the previous one with its prefix
+    # (the last couple of positions get shorter keys that never match)
+    head = {}
+    prev = [-1] * n
+
+    i = 0
+    while i < n:
+        flags_pos = len(out)
+        out.append(0)
+        flags = 0
+        for bit in range(8):
+            if i >= n:
+                break
+            best_len = 0
+            best_pos = 0
+            limit = n - i if n - i < LZSS_MAX_MATCH else LZSS_MAX_MATCH
+            key = data[i:i + LZSS_MIN_MATCH]
+            cand = head.get(key, -1)
+            prev[i] = cand
+            head[key] = i
+            if cand >= 0 and i - cand <= LZSS_WINDOW and limit >= LZSS_MIN_MATCH:
+                target = data[i:i + limit]
+                chain = effort
+                good = good_match if good_match < limit else limit
+                while cand >= 0 and i - cand <= LZSS_WINDOW and chain:
+                    # Matches may run into the bytes being produced, the
+                    # decoder copies one byte at a time
+                    if data[cand + best_len:cand + best_len + 1] == target[best_len:best_len + 1]:
+                        if data[cand:cand + limit] == target:
+                            best_len, best_pos = limit, cand
+                            break
+                        l = LZSS_MIN_MATCH
+                        while l < limit and data[cand + l] == target[l]:
+                            l += 1
+                        if l > best_len:
+                            best_len, best_pos = l, cand
+                            if l >= good:
+                                break
+                    cand = prev[cand]
+                    chain -= 1
+            if best_len >= LZSS_MIN_MATCH:
+                offset = (LZSS_START + best_pos) & 0xfff
+                out.append(offset & 0xff)
+                out.append(((offset >> 4) & 0xf0) | (best_len - LZSS_MIN_MATCH))
+                for p in range(i + 1, i + best_len):
+                    key = data[p:p + LZSS_MIN_MATCH]
+                    prev[p] = head.get(key, -1)
+                    head[key] = p
+                i += best_len
+            else:
+                flags |= 1 << bit
+                out.append(data[i])
+                i += 1
+        out[flags_pos] = flags
+    return bytes(out)
+
+def lzss_decompress_python(data, dsize):
+    p = 0
+    dictb = [0] * 0x1000
+    bp = 0xfee
+    dout = []
+    while len(dout) < dsize:
+        flags = data[p]
+        p += 1
+        for i in range(8):
+            if flags & 1:
+                dout.append(data[p])
+                dictb[bp] = data[p]
+                p += 1
+                bp = (bp + 1) & 0xfff
+            else:
+                a, b = data[p:p + 2]
+                p += 2
+                offset = ((b << 4) & 0xf00) | a
+                length = (b & 0xf) + 3
+                for i in range(length):
+                    dout.append(dictb[(offset + i) & 0xfff])
+                    dictb[bp] = dictb[(offset + i) & 0xfff]
+                    bp = (bp + 1) & 0xfff
+            flags >>= 1
+            if len(dout) >= dsize:
+                break
+    return bytes(dout[:dsize])
+
 class LZSSAdapter(Subconstruct):
+    # stage: what this section is called in profiling reports
+    def __init__(self, subcon, effort=LZSS_EFFORT, stage="lzss"):
+        super().__init__(subcon)
+        self.effort = effort
+        self.stage = stage
+
     def _parse(self, stream, context, path):
+        with profiling.stage(self.stage):
+            with profiling.stage("decompress"):
+                data = self._decompress(stream, context, path)
+            profiling.count("lzss_bytes", len(data))
+            return self.subcon._parse(io.BytesIO(data), context, path)
+
+    def _decompress(self, stream, context, path):
         lz = LZSSBlock._parse(stream, context, path)
-        dsize = lz.dsize
-        data = lz.data
-        p = 0
-        dictb = [0] * 0x1000
-        bp = 0xfee
-        dout = []
-        while len(dout) < dsize:
-            flags = data[p]
-            p += 1
-            for i in range(8):
-                if flags & 1:
-                    dout.append(data[p])
-                    dictb[bp] = data[p]
-                    p += 1
-                    bp = (bp + 1) & 0xfff
-                else:
-                    a, b = data[p:p + 2]
-                    p += 2
-                    offset = ((b << 4) & 0xf00) | a
-                    length = (b & 0xf) + 3
-                    for i in range(length):
-                        dout.append(dictb[(offset + i) & 0xfff])
-                        dictb[bp] = dictb[(offset + i) & 0xfff]
-                        bp = (bp + 1) & 0xfff
-                flags >>= 1
-                if len(dout) >= dsize:
-                    break
-        return self.subcon._parse(io.BytesIO(bytes(dout[:dsize])), context, path)
+        return lzss_decompress(lz.data, lz.dsize)
 
     def _build(self, obj, stream, context, path):
-        raise NotImplementedError()
+        raw = io.BytesIO()
+        obj = self.subcon._build(obj, raw, context, path)
+        data = raw.getvalue()
+        lz = lzss_compress(data, self.effort)
+        LZSSBlock._build(dict(unk=0, csize=len(lz), dsize=len(data), data=lz),
+                         stream, context, path)
+        return obj
 
     def _sizeof(self, context, path):
         raise SizeofError
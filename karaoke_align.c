@@ -0,0 +1,954 @@
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+#include <complex.h>
+#include <unistd.h>
+#include <pthread.h>
+
+#include "karaoke_align.h"
+
+#define SINC_OVERSAMPLING 32
+#define SINC_WIDTH 33
+#define SINC_SIZE (((SINC_WIDTH - 1) * SINC_OVERSAMPLING) + 1)
+
+#define COARSE_SIZE 15000
+#define COARSE_MAX_SHIFT 200000
+// Normalized cross-correlation below which the FFT search is not trusted
+#define COARSE_MIN_SCORE 0.2
+// Probe offsets closer than this are considered to agree
+#define COARSE_AGREE 1000
+// L1 refinement range around the cross-correlation peak
+#define COARSE_REFINE 16
+
+#define FINE_SIZE 256
+#define FINE_MAX_SHIFT 128
+#define FINE_SUBDIV 32
+#define FINE_UNIT (1.0/FINE_SUBDIV)
+#define FINE_INTERVAL 25000
+// Extra samples of B read around each fine search window
+#define FINE_MARGIN (FINE_MAX_SHIFT + SINC_WIDTH / 2)
+
+#define Q_FACTOR 2.5
+//#define Q_FACTOR 1
+
+#define MIXDOWN
+#define HPF
+#define HPF_A 0.8
+// Samples the highpass runs on before a streamed window; its state decays
+// by HPF_A per sample, so this is exact in float
+#define HPF_WARMUP 1024
+
+#define FINE_DQ -50
+// Fine search points seeded together, from the points accepted before them
+#define FINE_BLOCK 16
+
+#define MAP_MAGIC "karaoke_align map 1"
+#define HASH_CHUNK (1 << 20)
+
+#define LOG(...) do { if (al->verbose) printf(__VA_ARGS__); } while (0)
+
+static float s_tab[SINC_SIZE];
+// Sinc taps for each FINE_SUBDIV fractional phase, so the fine search
+// inner loop is a plain multiply-accumulate
+static float poly_tab[FINE_SUBDIV][SINC_WIDTH - 1];
+// s_tab split by phase, render_tab[ph][i] = s_tab[ph + i * SINC_OVERSAMPLING]
+// (zero past its end), so the taps for any fractional position are a blend
+// of two contiguous rows
+static float render_tab[SINC_OVERSAMPLING + 2][SINC_WIDTH - 1];
+static pthread_once_t tables_once = PTHREAD_ONCE_INIT;
+
+// One fine search, run on a worker thread
+struct fine_job {
+    struct ka_aligner *al;
+    int pos;
+    int seed;
+    float *a, *b;
+    double doff;
+    float q;
+};
+
+// The following two functions taken from SPUC, GPLv2+
+// See http://spuc.sourceforge.net/
+
+static double io(double x)
+{
+    const double t = 1.e-08;
+    double y = 0.5*x;
+    double e = 1.0;
+    double de = 1.0;
+    int i;
+    double xi;
+    double sde;
+    for (i=1;i<26;i++) {
+        xi = i;
+        de *= y/xi;
+        sde = de*de;
+        e += sde;
+        if ((e*t-sde) > 0) break;
+    }
+    return(e);
+}
+
+static void kaiser(double* w,long nf, double beta)
+{
+    // nf = filter length in samples
+    // beta = parameter of kaiser window
+    double bes = 1.0/io(beta);
+    long i;
+    long odd = nf%2;
+    double xi;
+    double xind = (nf-1)*(nf-1);
+    for (i=0;i<(nf/2);i++) {
+        if (odd) xi = i + 0.5;
+        else xi = i;
+        xi = 4*xi*xi;
+        w[i]  = io(beta*sqrt(1.-xi/xind))*bes;
+    }
+    w[nf/2] = 0;
+}
+
+static void build_sinc_table(void)
+{
+    double k[SINC_SIZE];
+    kaiser(k, SINC_SIZE, 7.68);
+    int i;
+    for (i = 0; i < SINC_SIZE; i++) {
+        float x = ((float)(i - (SINC_SIZE / 2))) / SINC_OVERSAMPLING;
+        float val = 1;
+        if (x != 0)
+            val = (sin(M_PI * x) / (M_PI * x)) * k[abs(i - (SINC_SIZE/2))];
+        s_tab[i] = val;
+    }
+}
+
+static void build_poly_table(void)
+{
+    int ph, i;
+    for (ph = 0; ph < FINE_SUBDIV; ph++) {
+        float spos = (1 - ph * FINE_UNIT) * SINC_OVERSAMPLING;
+        int sipos = spos;
+        float f2 = spos - sipos;
+        float f1 = 1 - f2;
+        for (i = 0; i < (SINC_WIDTH - 1); i++) {
+            int idx = sipos + i * SINC_OVERSAMPLING;
+            float next = (idx + 1) < SINC_SIZE ? s_tab[idx + 1] : 0;
+            poly_tab[ph][i] = s_tab[idx] * f1 + next * f2;
+        }
+    }
+}
+
+static void build_render_table(void)
+{
+    int ph, i;
+    for (ph = 0; ph < (SINC_OVERSAMPLING + 2); ph++) {
+        for (i = 0; i < (SINC_WIDTH - 1); i++) {
+            int idx = ph + i * SINC_OVERSAMPLING;
+            render_tab[ph][i] = idx < SINC_SIZE ? s_tab[idx] : 0;
+        }
+    }
+}
+
+static void build_tables(void)
+{
+    build_sinc_table();
+    build_poly_table();
+    build_render_table();
+}
+
+static void mixdown(float *out, const float *in, long len)
+{
+    while (len--) {
+        *out++ = in[0] - in[1];
+        in+=2;
+    }
+}
+
+static void hpf(float *out, const float *in, long len, int ch)
+{
+    struct {
+        float yx, ix;
+    } state[ch];
+    memset(state, 0, sizeof(state));
+    int i;
+    float a = HPF_A;
+    while (len--) {
+        for (i=0; i<ch; i++) {
+            float x = in[i];
+            out[i] = state[i].yx = a * state[i].yx + a * (x - state[i].ix);
+            state[i].ix = x;
+        }
+        in+=ch;
+        out+=ch;
+    }
+}
+
+// Turn len frames of audio into the signal the searches work on. out may
+// be the same buffer as in.
+static void search_signal(struct ka_aligner *al, float *out, const float *in, long len)
+{
+#ifdef MIXDOWN
+    if (al->search_channels != al->channels) {
+        mixdown(out, in, len);
+        in = out;
+    }
+#endif
+#ifdef HPF
+    hpf(out, in, len, al->search_channels);
+#else
+    if (out != in)
+        memcpy(out, in, sizeof(float) * al->search_channels * len);
+#endif
+}
+
+// Prepare out for frames [start, start + n) of a ch channel signal of len
+// frames: zero it, and return where frame *lo goes. Frames [*lo, *hi) are
+// the ones that actually exist.
+static float *clip_window(long len, long start, long n, int ch, float *out, long *lo, long *hi)
+{
+    *lo = start < 0 ? 0 : start;
+    *hi = (start + n) > len ? len : (start + n);
+    memset(out, 0, sizeof(float) * ch * n);
+    return out + (*lo - start) * ch;
+}
+
+// Read frames [start, start + n) of a track, zero outside of it
+static void read_frames(struct ka_aligner *al, struct ka_track *t, long start, long n, float *out)
+{
+    long lo, hi;
+    float *p = clip_window(t->len, start, n, al->channels, out, &lo, &hi);
+
+    if (lo >= hi)
+        return;
+    if (t->buf)
+        memcpy(p, t->buf + lo * al->channels, sizeof(float) * al->channels * (hi - lo));
+    else
+        t->read(t->opaque, lo, hi - lo, p);
+}
+
+// Same as read_frames(), for the search signal
+static void read_search(struct ka_aligner *al, struct ka_track *t, long start, long n, float *out)
+{
+    int sc = al->search_channels;
+
+    if (t->search) {
+        long lo, hi;
+        float *p = clip_window(t->len, start, n, sc, out, &lo, &hi);
+        if (lo < hi)
+            memcpy(p, t->search + lo * sc, sizeof(float) * sc * (hi - lo));
+        return;
+    }
+
+    float *tmp = malloc(sizeof(float) * al->channels * (n + HPF_WARMUP));
+    read_frames(al, t, start - HPF_WARMUP, n + HPF_WARMUP, tmp);
+    search_signal(al, tmp, tmp, n + HPF_WARMUP);
+    memcpy(out, tmp + HPF_WARMUP * sc, sizeof(float) * sc * n);
+    free(tmp);
+}
+
+static int coarse_search(struct ka_aligner *al, float *ref, float *p)
+{
+    int shift = -COARSE_MAX_SHIFT/2;
+    int sc = al->search_channels;
+    int i;
+
+    int best = -1;
+    float bestv = 0;
+
+    for (shift = -COARSE_MAX_SHIFT/2; shift < COARSE_MAX_SHIFT; shift++) {
+        float *a, *b;
+        a = ref;
+        b = p + shift * sc;
+        float acc = 0;
+        for (i = 0; i < (COARSE_SIZE * sc); i++) {
+            acc -= fabsf(*a++ - *b++);
+        }
+        if (best == -1 || acc > bestv) {
+            best = shift;
+            bestv = acc;
+        }
+    }
+    return best;
+}
+
+static float coarse_l1(struct ka_aligner *al, float *ref, float *p, int shift)
+{
+    int i;
+    float acc = 0;
+    p += shift * al->search_channels;
+    for (i = 0; i < (COARSE_SIZE * al->search_channels); i++)
+        acc -= fabsf(ref[i] - p[i]);
+    return acc;
+}
+
+// Read the windows a coarse search at pos works on: COARSE_SIZE frames of
+// A, and B over the whole shift range plus the L1 refinement range. B at
+// pos is at *b + COARSE_B_START * search_channels.
+#define COARSE_SPAN (COARSE_MAX_SHIFT / 2 + COARSE_MAX_SHIFT + COARSE_SIZE)
+#define COARSE_B_START (COARSE_MAX_SHIFT / 2 + COARSE_REFINE)
+
+static void load_coarse(struct ka_aligner *al, long pos, float **a, float **b)
+{
+    int sc = al->search_channels;
+    *a = malloc(sizeof(float) * sc * COARSE_SIZE);
+    *b = malloc(sizeof(float) * sc * (COARSE_SPAN + 2 * COARSE_REFINE));
+    read_search(al, &al->a, pos, COARSE_SIZE, *a);
+    read_search(al, &al->b, pos - COARSE_B_START, COARSE_SPAN + 2 * COARSE_REFINE, *b);
+}
+
+static int coarse_search_l1(struct ka_aligner *al, long pos)
+{
+    float *a, *b;
+    load_coarse(al, pos, &a, &b);
+    int off = coarse_search(al, a, b + COARSE_B_START * al->search_channels);
+    free(a);
+    free(b);
+    return off;
+}
+
+static void fft(double complex *x, const double complex *tw, int n, int inverse)
+{
+    int i, j, k, len;
+
+    for (i = 1, j = 0; i < n; i++) {
+        int bit = n >> 1;
+        for (; j & bit; bit >>= 1)
+            j ^= bit;
+        j ^= bit;
+        if (i < j) {
+            double complex t = x[i];
+            x[i] = x[j];
+            x[j] = t;
+        }
+    }
+    for (len = 2; len <= n; len <<= 1) {
+        int step = n / len;
+        for (i = 0; i < n; i += len) {
+            for (k = 0; k < len / 2; k++) {
+                double complex w = inverse ? conj(tw[k * step]) : tw[k * step];
+                double complex u = x[i + k];
+                double complex v = x[i + k + len / 2] * w;
+                x[i + k] = u + v;
+                x[i + k + len / 2] = u - v;
+            }
+        }
+    }
+}
+
+// Cross-correlate the COARSE_SIZE window at pos in A against the whole
+// shift range in B at once, then pick the best normalized correlation and
+// refine it with the L1 metric coarse_search() uses.
+static int coarse_search_fft(struct ka_aligner *al, long pos, float *score)
+{
+    long span = COARSE_SPAN;
+    int sc = al->search_channels;
+    int n = 1;
+    long i;
+    int c;
+    float *win_a, *win_b;
+
+    while (n < span)
+        n <<= 1;
+
+    load_coarse(al, pos, &win_a, &win_b);
+    float *pos_b = win_b + COARSE_B_START * sc;
+
+    double complex *tw = malloc(sizeof(*tw) * n / 2);
+    double complex *fa = malloc(sizeof(*fa) * n);
+    double complex *fb = malloc(sizeof(*fb) * n);
+    double complex *acc = calloc(n, sizeof(*acc));
+    double *energy = calloc(span + 1, sizeof(*energy));
+    double energy_a = 0;
+
+    for (i = 0; i < n / 2; i++)
+        tw[i] = cexp(-2 * M_PI * I * i / n);
+
+    for (c = 0; c < sc; c++) {
+        for (i = 0; i < n; i++) {
+            float va = i < COARSE_SIZE ? win_a[i * sc + c] : 0;
+            float vb = i < span ? win_b[(i + COARSE_REFINE) * sc + c] : 0;
+            fa[i] = va;
+            fb[i] = vb;
+            energy_a += va * va;
+            if (i < span)
+                energy[i + 1] += vb * vb;
+        }
+        fft(fa, tw, n, 0);
+        fft(fb, tw, n, 0);
+        for (i = 0; i < n; i++)
+            acc[i] += fb[i] * conj(fa[i]);
+    }
+    fft(acc, tw, n, 1);
+
+    // Running sum of B's energy, for the normalization
+    for (i = 0; i < span; i++)
+        energy[i + 1] += energy[i];
+
+    long best = -1;
+    double bestv = 0;
+    for (i = 0; i < COARSE_MAX_SHIFT / 2 + COARSE_MAX_SHIFT; i++) {
+        double e = energy[i + COARSE_SIZE] - energy[i];
+        if (e <= 0 || energy_a <= 0)
+            continue;
+        double v = creal(acc[i]) / n / sqrt(energy_a * e);
+        if (best == -1 || v > bestv) {
+            best = i;
+            bestv = v;
+        }
+    }
+
+    free(tw);
+    free(fa);
+    free(fb);
+    free(acc);
+    free(energy);
+
+    if (best == -1) {
+        free(win_a);
+        free(win_b);
+        *score = 0;
+        return 0;
+    }
+
+    int shift = best - COARSE_MAX_SHIFT / 2;
+    int refined = shift;
+    float refv = coarse_l1(al, win_a, pos_b, shift);
+    for (c = shift - COARSE_REFINE; c <= shift + COARSE_REFINE; c++) {
+        float v = coarse_l1(al, win_a, pos_b, c);
+        if (v > refv) {
+            refv = v;
+            refined = c;
+        }
+    }
+    free(win_a);
+    free(win_b);
+
+    *score = bestv;
+    return refined;
+}
+
+// Run the FFT search on several probe windows and take the offset most of
+// them agree on. Falls back to the L1 search on the window at *pos if no
+// probe correlates well. On return *pos is the window the offset belongs
+// to, which is where fine tuning should start.
+static int coarse_search_probes(struct ka_aligner *al, int *pos, int nprobes)
+{
+    long len_a = al->a.len;
+    int probe_pos[nprobes];
+    int probe_off[nprobes];
+    float probe_score[nprobes];
+    int i, j;
+
+    // The first probe is the starting window, the rest are spread evenly
+    probe_pos[0] = *pos;
+    for (i = 1; i < nprobes; i++) {
+        long p = len_a * (long)(2 * i - 1) / (2 * (nprobes - 1));
+        if (p < COARSE_MAX_SHIFT)
+            p = COARSE_MAX_SHIFT;
+        if (p > len_a - COARSE_SIZE - FINE_INTERVAL)
+            p = len_a - COARSE_SIZE - FINE_INTERVAL;
+        probe_pos[i] = p;
+    }
+
+    for (i = 0; i < nprobes; i++) {
+        probe_off[i] = coarse_search_fft(al, probe_pos[i], &probe_score[i]);
+        LOG("Probe at %d: offset %d score %f\n", probe_pos[i], probe_off[i], probe_score[i]);
+    }
+
+    int best = -1;
+    float best_support = 0;
+    for (i = 0; i < nprobes; i++) {
+        float support = 0;
+        if (probe_score[i] < COARSE_MIN_SCORE)
+            continue;
+        for (j = 0; j < nprobes; j++)
+            if (probe_score[j] >= COARSE_MIN_SCORE && abs(probe_off[i] - probe_off[j]) < COARSE_AGREE)
+                support += probe_score[j];
+        // Prefer the starting window on ties
+        if (best == -1 || support > best_support) {
+            best = i;
+            best_support = support;
+        }
+    }
+
+    if (best == -1) {
+        LOG("No reliable probe, falling back to L1 search\n");
+        return coarse_search_l1(al, *pos);
+    }
+
+    *pos = probe_pos[best];
+    return probe_off[best];
+}
+
+static double fine_search(int sc, float *ref, float *p, float *quality)
+{
+    int n = FINE_SIZE * sc;
+    float out[n];
+    int have_best = 0;
+    int best = 0;
+    float bestv = 0;
+    float rms = 0;
+    int step, i, k;
+
+    for (i = 0; i < n; i++)
+        rms += ref[i]*ref[i];
+    rms = sqrtf(rms);
+
+    for (step = -FINE_MAX_SHIFT * FINE_SUBDIV; step < FINE_MAX_SHIFT * FINE_SUBDIV; step++) {
+        // floor division, shifts are negative half of the time
+        int ipos = step >= 0 ? step / FINE_SUBDIV : -((-step + FINE_SUBDIV - 1) / FINE_SUBDIV);
+        float *taps = poly_tab[step - ipos * FINE_SUBDIV];
+        float *src = p + (ipos - ((SINC_WIDTH / 2) - 1)) * sc;
+        float acc = 0;
+
+        // Filter the whole window one tap at a time, which vectorizes
+        memset(out, 0, sizeof(out));
+        for (k = 0; k < (SINC_WIDTH - 1); k++) {
+            float t = taps[k];
+            float *s = src + k * sc;
+            for (i = 0; i < n; i++)
+                out[i] += t * s[i];
+        }
+        for (i = 0; i < n; i++)
+            acc -= fabsf(ref[i] - out[i]);
+        acc /= rms;
+        if (!have_best || acc > bestv) {
+            best = step;
+            bestv = acc;
+            have_best = 1;
+        }
+    }
+    *quality = bestv;
+    return best * FINE_UNIT;
+}
+
+static void *fine_worker(void *arg)
+{
+    struct fine_job *job = arg;
+    int sc = job->al->search_channels;
+    job->doff = fine_search(sc, job->a, job->b + FINE_MARGIN * sc, &job->q);
+    return NULL;
+}
+
+static void run_fine_jobs(struct fine_job *jobs, int njobs)
+{
+    pthread_t threads[njobs];
+    int started, i;
+
+    if (njobs == 1) {
+        fine_worker(&jobs[0]);
+        return;
+    }
+    for (started = 0; started < njobs; started++)
+        if (pthread_create(&threads[started], NULL, fine_worker, &jobs[started]))
+            break;
+    // Out of threads, do the rest here
+    for (i = started; i < njobs; i++)
+        fine_worker(&jobs[i]);
+    for (i = 0; i < started; i++)
+        pthread_join(threads[i], NULL);
+}
+
+static int fine_in_range(struct ka_aligner *al, int pos, int ioff, int dir)
+{
+    if (dir > 0)
+        return pos < (al->a.len - FINE_INTERVAL) && (pos + ioff) <= (al->b.len - FINE_INTERVAL);
+    else
+        return pos > FINE_INTERVAL && (pos + ioff) >= FINE_INTERVAL;
+}
+
+/*
+ * Walk control points from pos in steps of dir * FINE_INTERVAL, tracking the
+ * offset as it drifts. Points are taken in blocks of FINE_BLOCK, each seeded
+ * with the offset extrapolated from the last two accepted points (the
+ * tracked offset until there are two), and then accepted or rejected in
+ * order against the tracked offset. The seeds only depend on the points
+ * before the block, so the blocks are searched up to nthreads points at a
+ * time and the result is the same for any number of threads. Until the
+ * drift is known, blocks are kept short, so that it cannot run out of the
+ * search window.
+ * The windows are read up front, so track reads stay on the calling thread.
+ */
+static int fine_pass(struct ka_aligner *al, int pos, int dir, int ioff,
+                     struct ka_point *points, float *sum_q)
+{
+    int nthreads = al->nthreads < 1 ? 1 : al->nthreads;
+    int sc = al->search_channels;
+    int njobs = nthreads < FINE_BLOCK ? nthreads : FINE_BLOCK;
+    struct fine_job jobs[njobs];
+    int npoints = 0;
+    int nf = 1;
+    int done = 0;
+    // Drift per sample, between the last two accepted points
+    double slope = 0;
+    int i, j, k;
+
+    for (i = 0; i < njobs; i++) {
+        jobs[i].al = al;
+        jobs[i].a = malloc(sizeof(float) * sc * FINE_SIZE);
+        jobs[i].b = malloc(sizeof(float) * sc * (FINE_SIZE + 2 * FINE_MARGIN));
+    }
+
+    while (!done && fine_in_range(al, pos, ioff, dir)) {
+        int block = npoints < 2 ? 1 : FINE_BLOCK;
+        int seeds[FINE_BLOCK];
+        int nblock = 0;
+        for (i = 0; i < block; i++) {
+            int jpos = pos + i * dir * FINE_INTERVAL;
+            int seed = ioff;
+            if (npoints) {
+                const struct ka_point *last = &points[npoints - 1];
+                seed = lrint(last->offset + slope * (jpos - last->pos));
+            }
+            if (!fine_in_range(al, jpos, seed, dir))
+                break;
+            seeds[nblock++] = seed;
+        }
+        if (!nblock) {
+            // Only when the drift runs the tracked offset out of range
+            seeds[nblock++] = ioff;
+        }
+
+        for (j = 0; !done && j < nblock; j += njobs) {
+            int n = nblock - j < njobs ? nblock - j : njobs;
+            for (k = 0; k < n; k++) {
+                struct fine_job *job = &jobs[k];
+                job->pos = pos;
+                job->seed = seeds[j + k];
+                read_search(al, &al->a, pos, FINE_SIZE, job->a);
+                read_search(al, &al->b, pos + job->seed - FINE_MARGIN, FINE_SIZE + 2 * FINE_MARGIN, job->b);
+                pos += dir * FINE_INTERVAL;
+            }
+            run_fine_jobs(jobs, n);
+
+            for (k = 0; k < n; k++) {
+                struct fine_job *job = &jobs[k];
+                if (!fine_in_range(al, job->pos, ioff, dir)) {
+                    done = 1;
+                    break;
+                }
+                double offset = job->seed + job->doff;
+                double doff = offset - ioff;
+                double dq = job->q * fabsf(doff) / nf;
+                if (dq > FINE_DQ) {
+                    LOG("Fine at %d: offset %f q %f delta %f dp %f\n", job->pos, offset, job->q, doff, dq);
+                    if (npoints)
+                        slope = (offset - points[npoints - 1].offset) / (job->pos - points[npoints - 1].pos);
+                    points[npoints].pos = job->pos;
+                    points[npoints].offset = offset;
+                    points[npoints].quality = job->q;
+                    npoints++;
+                    *sum_q += job->q;
+                    ioff += (int)doff;
+                    nf = 1;
+                } else {
+                    LOG("Fail at %d: offset %f q %f delta %f dp %f\n", job->pos, offset, job->q, doff, dq);
+                    nf += 1;
+                }
+                if (doff > 0)
+                    LOG(">");
+                else
+                    LOG("<");
+                if (al->verbose)
+                    fflush(stdout);
+            }
+        }
+    }
+
+    for (i = 0; i < njobs; i++) {
+        free(jobs[i].a);
+        free(jobs[i].b);
+    }
+    return npoints;
+}
+
+// Drop low quality points and offset outliers, in place
+static int filter_points(struct ka_aligner *al, struct ka_point *points, int npoints, float sum_q)
+{
+    int i;
+    float avg_q = sum_q / npoints;
+    double sum_off = 0;
+    double sum2_off = 0;
+    int valid_points = 0;
+    for (i = 0; i < npoints; i++) {
+        points[i].valid = 0;
+        if (points[i].quality > Q_FACTOR*avg_q) {
+            sum_off += points[i].offset;
+            sum2_off += points[i].offset * points[i].offset;
+            points[i].valid = 1;
+            valid_points++;
+        }
+    }
+    LOG("%d %f %f\n", valid_points, sum_off, sum2_off);
+    double avg_off = sum_off / valid_points;
+    double stdev_off = sqrtf((sum2_off / valid_points) - avg_off * avg_off);
+
+    LOG("Average offset: %f, stdev %f, avg q %f\n", avg_off, stdev_off, avg_q);
+
+    valid_points = 0;
+    for (i = 0; i < npoints; i++) {
+        if (points[i].valid && fabsf(points[i].offset - avg_off) < 2 * stdev_off) {
+            points[valid_points++] = points[i];
+        }
+    }
+
+    for (i = 0; i < valid_points; i++)
+        LOG("%d: %d %f %f\n", i, points[i].pos, points[i].offset, points[i].quality);
+
+    return valid_points;
+}
+
+void ka_init(struct ka_aligner *al, int channels)
+{
+    pthread_once(&tables_once, build_tables);
+
+    memset(al, 0, sizeof(*al));
+    al->channels = channels;
+    al->nthreads = sysconf(_SC_NPROCESSORS_ONLN);
+    al->coarse_fft = 1;
+    al->nprobes = 3;
+
+    al->search_channels = channels;
+#ifdef MIXDOWN
+    if (channels == 2)
+        al->search_channels = 1;
+#endif
+}
+
+void ka_cleanup(struct ka_aligner *al)
+{
+    free(al->a.search);
+    free(al->b.search);
+    al->a.search = NULL;
+    al->b.search = NULL;
+}
+
+int ka_max_points(const struct ka_aligner *al)
+{
+    return al->a.len / FINE_INTERVAL + 1;
+}
+
+int ka_align(struct ka_aligner *al, struct ka_point *points)
+{
+    struct ka_track *tracks[2] = {&al->a, &al->b};
+    int i;
+
+    // Whole tracks get their search signal computed once up front
+    for (i = 0; i < 2; i++) {
+        struct ka_track *t = tracks[i];
+        if (t->buf && !t->search) {
+            t->search = malloc(sizeof(float) * al->search_channels * t->len);
+            search_signal(al, t->search, t->buf, t->len);
+        }
+    }
+
+    int mid_pos = al->a.len / 3;
+    if (mid_pos < COARSE_MAX_SHIFT)
+        mid_pos = COARSE_MAX_SHIFT;
+
+    LOG("Performing coarse search...\n");
+    int ioff;
+    if (al->coarse_fft)
+        ioff = coarse_search_probes(al, &mid_pos, al->nprobes < 1 ? 1 : al->nprobes);
+    else
+        ioff = coarse_search_l1(al, mid_pos);
+    LOG("Coarse offset: %d samples\n", ioff);
+
+    int max_points = ka_max_points(al);
+    struct ka_point *points_b = malloc(sizeof(*points_b) * max_points);
+
+    LOG("Fine tuning...");
+    float sum_q = 0;
+    int npoints = fine_pass(al, mid_pos, 1, ioff, points, &sum_q);
+    LOG("|");
+    int npoints_b = fine_pass(al, mid_pos - FINE_INTERVAL, -1, ioff, points_b, &sum_q);
+
+    // The backward pass found its points in reverse order
+    memmove(points + npoints_b, points, sizeof(*points) * npoints);
+    for (i = 0; i < npoints_b; i++)
+        points[i] = points_b[npoints_b - 1 - i];
+    npoints += npoints_b;
+    free(points_b);
+    LOG(" done\n");
+
+    if (!npoints)
+        return -1;
+    npoints = filter_points(al, points, npoints, sum_q);
+    if (npoints < 2)
+        return -1;
+    return npoints;
+}
+
+void ka_render(struct ka_aligner *al, const struct ka_point *points, int npoints,
+               long start, long n, float *out)
+{
+    int channels = al->channels;
+    long len_b = al->b.len;
+    float *in_a = malloc(sizeof(float) * channels * n);
+    float *offs = malloc(sizeof(float) * n);
+    float min_off = 0, max_off = 0;
+    float taps[SINC_WIDTH - 1];
+    long i, j;
+    int ch, k;
+
+    // Control points pp[0] and pp[1] bracket the current position
+    int point_idx = 2;
+    const struct ka_point *pp = points;
+    while (point_idx < npoints && start >= pp[1].pos) {
+        pp++;
+        point_idx++;
+    }
+
+    for (i = 0; i < n; i++) {
+        long pos = start + i;
+        if (pos >= pp[1].pos && point_idx < npoints) {
+            pp++;
+            point_idx++;
+        }
+
+        float pos_p = (pos - pp[0].pos) / (float)(pp[1].pos - pp[0].pos);
+        pos_p = fminf(fmaxf(pos_p, 0), 1);
+        offs[i] = pp[1].offset * pos_p + pp[0].offset * (1 - pos_p);
+        if (!i || offs[i] < min_off)
+            min_off = offs[i];
+        if (!i || offs[i] > max_off)
+            max_off = offs[i];
+    }
+
+    // The part of B this block interpolates from, split into one plane per
+    // channel so every filter runs over contiguous samples
+    long b_start = start + (long)floorf(min_off) - SINC_WIDTH / 2;
+    long b_len = n + (long)ceilf(max_off) - (long)floorf(min_off) + SINC_WIDTH + 1;
+    float *in_b = malloc(sizeof(float) * channels * b_len);
+    float *planes = malloc(sizeof(float) * channels * b_len);
+    read_frames(al, &al->a, start, n, in_a);
+    read_frames(al, &al->b, b_start, b_len, in_b);
+    for (j = 0; j < b_len; j++)
+        for (ch = 0; ch < channels; ch++)
+            planes[ch * b_len + j] = in_b[j * channels + ch];
+
+    for (i = 0; i < n; i++) {
+        long pos = start + i;
+        float *p_a = &in_a[i * channels];
+        float *p_o = &out[i * channels * 2];
+        float off = offs[i];
+
+        for (ch = 0; ch < channels; ch++)
+            p_o[ch+channels] = p_a[ch] * 0.8;
+
+        if ((pos + off) < (SINC_WIDTH / 2) || (pos + off) > (len_b - SINC_WIDTH / 2)) {
+            for (ch = 0; ch < channels; ch++)
+                p_o[ch] = 0;
+            continue;
+        }
+
+        // Windowed sinc, linearly interpolated between the table's phases.
+        // The taps are blended once per frame and shared by all channels.
+        double bpos = (double)pos + off - b_start;
+        long ipos = floor(bpos);
+        float ioff = 1 - (bpos - ipos);
+        float spos = ioff * SINC_OVERSAMPLING;
+        int sipos = spos;
+        float f2 = spos - sipos;
+        float f1 = 1 - f2;
+        const float *r0 = render_tab[sipos];
+        const float *r1 = render_tab[sipos + 1];
+        for (k = 0; k < (SINC_WIDTH - 1); k++)
+            taps[k] = r0[k] * f1 + r1[k] * f2;
+
+        for (ch = 0; ch < channels; ch++) {
+            const float *p = planes + ch * b_len + ipos - ((SINC_WIDTH / 2) - 1);
+            float sum = 0;
+            for (k = 0; k < (SINC_WIDTH - 1); k++)
+                sum += taps[k] * p[k];
+            p_o[ch] = sum * 0.8;
+        }
+    }
+
+    free(in_a);
+    free(in_b);
+    free(planes);
+    free(offs);
+}
+
+int ka_hash_file(const char *filename, uint64_t *hash)
+{
+    FILE *fd = fopen(filename, "rb");
+    if (!fd)
+        return -1;
+
+    unsigned char *buf = malloc(HASH_CHUNK);
+    // 64-bit FNV-1a
+    uint64_t h = 0xcbf29ce484222325ULL;
+    size_t n, i;
+    while ((n = fread(buf, 1, HASH_CHUNK, fd)) > 0) {
+        for (i = 0; i < n; i++) {
+            h ^= buf[i];
+            h *= 0x100000001b3ULL;
+        }
+    }
+    int err = ferror(fd);
+    free(buf);
+    fclose(fd);
+    if (err)
+        return -1;
+    *hash = h;
+    return 0;
+}
+
+int ka_save_map(const char *filename, uint64_t hash_a, uint64_t hash_b,
+                const struct ka_point *points, int npoints)
+{
+    size_t len = strlen(filename) + 32;
+    char tmp[len];
+    int i;
+
+    snprintf(tmp, len, "%s.%d.tmp", filename, (int)getpid());
+    FILE *fd = fopen(tmp, "w");
+    if (!fd)
+        return -1;
+
+    fprintf(fd, "%s\n", MAP_MAGIC);
+    fprintf(fd, "inputs %016llx %016llx\n", (unsigned long long)hash_a, (unsigned long long)hash_b);
+    fprintf(fd, "points %d\n", npoints);
+    // %.9g round-trips floats exactly
+    for (i = 0; i < npoints; i++)
+        fprintf(fd, "%d %.9g %.9g\n", points[i].pos, points[i].offset, points[i].quality);
+
+    if (ferror(fd) | fclose(fd) || rename(tmp, filename)) {
+        unlink(tmp);
+        return -1;
+    }
+    return 0;
+}
+
+int ka_load_map(const char *filename, uint64_t hash_a, uint64_t hash_b,
+                struct ka_point *points, int max_points)
+{
+    char magic[64];
+    unsigned long long map_a, map_b;
+    int npoints, i;
+
+    FILE *fd = fopen(filename, "r");
+    if (!fd)
+        return -1;
+
+    if (!fgets(magic, sizeof(magic), fd) || strcmp(magic, MAP_MAGIC "\n") ||
+        fscanf(fd, "inputs %llx %llx points %d", &map_a, &map_b, &npoints) != 3 ||
+        map_a != hash_a || map_b != hash_b || npoints < 2 || npoints > max_points) {
+        fclose(fd);
+        return -1;
+    }
+
+    for (i = 0; i < npoints; i++) {
+        if (fscanf(fd, "%d %f %f", &points[i].pos, &points[i].offset, &points[i].quality) != 3) {
+            fclose(fd);
+            return -1;
+        }
+        points[i].valid = 1;
+    }
+    fclose(fd);
+    return npoints;
+}
+
+// kate: space-indent on; indent-width 4; mixedindent off; indent-mode cstyle;
@@ -0,0 +1,87 @@
+#ifndef KARAOKE_ALIGN_H
+#define KARAOKE_ALIGN_H
+
+#include <stdint.h>
+
+/*
+ * Alignment core of combine_karaoke: finds the offset of an instrumental
+ * track (B) relative to the original (A) as a series of control points,
+ * and renders B resampled onto A's timeline.
+ *
+ * Tracks are interleaved float frames with the same channel count, either
+ * supplied whole by the caller or read on demand through a callback.
+ */
+
+struct ka_point {
+    int pos;
+    float offset;
+    float quality;
+    int valid;
+};
+
+// Fill out with frames [start, start + n) of a track. The range always lies
+// within the track. Only called from the thread that called ka_align() or
+// ka_render().
+typedef void (*ka_read_fn)(void *opaque, long start, long n, float *out);
+
+struct ka_track {
+    long len;
+    // The whole track, or NULL to read it through read
+    const float *buf;
+    ka_read_fn read;
+    void *opaque;
+
+    // private
+    float *search;
+};
+
+struct ka_aligner {
+    int channels;
+    // Fine search threads
+    int nthreads;
+    // Coarse search: FFT cross-correlation over nprobes windows, or plain L1
+    int coarse_fft;
+    int nprobes;
+    // Print progress to stdout
+    int verbose;
+
+    struct ka_track a, b;
+
+    // private
+    int search_channels;
+};
+
+// Set up an aligner with default settings and no tracks
+void ka_init(struct ka_aligner *al, int channels);
+// Free what ka_align() allocated for the tracks
+void ka_cleanup(struct ka_aligner *al);
+
+// Upper bound of the number of points ka_align() returns
+int ka_max_points(const struct ka_aligner *al);
+
+// Align the tracks, storing the filtered control points (sorted by pos) in
+// points. Returns their number, or -1 if there aren't enough to align.
+int ka_align(struct ka_aligner *al, struct ka_point *points);
+
+// Render frames [start, start + n) of A's timeline into out, as B's
+// channels aligned to A followed by A's channels (2 * channels per frame)
+void ka_render(struct ka_aligner *al, const struct ka_point *points, int npoints,
+               long start, long n, float *out);
+
+// Alignment maps: the control points of a pair of input files, saved so
+// that later renders of the same pair can skip the alignment. Inputs are
+// identified by a hash of their contents.
+
+// Hash a file's contents into *hash. Returns 0, or -1 if it can't be read.
+int ka_hash_file(const char *filename, uint64_t *hash);
+
+// Write points to filename, replacing it atomically. Returns 0 or -1.
+int ka_save_map(const char *filename, uint64_t hash_a, uint64_t hash_b,
+                const struct ka_point *points, int npoints);
+
+// Read up to max_points points back from filename. Returns their number, or
+// -1 if the file is missing, malformed or was made from other inputs.
+int ka_load_map(const char *filename, uint64_t hash_a, uint64_t hash_b,
+                struct ka_point *points, int max_points);
+
+#endif
@@ -0,0 +1,181 @@
+import os
+import ctypes
+from ctypes import c_int, c_long, c_float, c_void_p, c_char_p, c_uint64, POINTER, byref
+
+import numpy as np
+
+# Built by "make libkaraoke_align.so"
+LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "libkaraoke_align.so")
+
+# struct ka_point
+POINT_DTYPE = np.dtype([
+    ("pos", "<i4"),
+    ("offset", "<f4"),
+    ("quality", "<f4"),
+    ("valid", "<i4"),
+])
+
+class _Track(ctypes.Structure):
+    _fields_ = [
+        ("len", c_long),
+        ("buf", POINTER(c_float)),
+        ("read", c_void_p),
+        ("opaque", c_void_p),
+        ("search", POINTER(c_float)),
+    ]
+
+class _Aligner(ctypes.Structure):
+    _fields_ = [
+        ("channels", c_int),
+        ("nthreads", c_int),
+        ("coarse_fft", c_int),
+        ("nprobes", c_int),
+        ("verbose", c_int),
+        ("a", _Track),
+        ("b", _Track),
+        ("search_channels", c_int),
+    ]
+
+_lib = None
+
+def _load():
+    global _lib
+    if _lib is None:
+        lib = ctypes.CDLL(LIBRARY)
+        lib.ka_init.argtypes = [POINTER(_Aligner), c_int]
+        lib.ka_init.restype = None
+        lib.ka_cleanup.argtypes = [POINTER(_Aligner)]
+        lib.ka_cleanup.restype = None
+        lib.ka_max_points.argtypes = [POINTER(_Aligner)]
+        lib.ka_max_points.restype = c_int
+        lib.ka_align.argtypes = [POINTER(_Aligner), c_void_p]
+        lib.ka_align.restype = c_int
+        lib.ka_render.argtypes = [POINTER(_Aligner), c_void_p, c_int, c_long, c_long, c_void_p]
+        lib.ka_render.restype = None
+        lib.ka_hash_file.argtypes = [c_char_p, POINTER(c_uint64)]
+        lib.ka_hash_file.restype = c_int
+        lib.ka_save_map.argtypes = [c_char_p, c_uint64, c_uint64, c_void_p, c_int]
+        lib.ka_save_map.restype = c_int
+        lib.ka_load_map.argtypes = [c_char_p, c_uint64, c_uint64, c_void_p, c_int]
+        lib.ka_load_map.restype = c_int
+        _lib = lib
+    return _lib
+
+def _frames(x):
+    # Only copies if the caller's array isn't already float32 and contiguous
+    x = np.ascontiguousarray(x, dtype=np.float32)
+    if x.ndim == 1:
+        x = x.reshape(-1, 1)
+    if x.ndim != 2:
+        raise ValueError("Audio must be an array of (frames, channels)")
+    return x
+
+class Aligner(object):
+    """Aligns an instrumental track b to the original a, both arrays of
+    (frames, channels) float32 samples at the same rate. The arrays are used
+    in place (they are only copied if they are not float32 and contiguous),
+    and the library releases the GIL, so several pairs can be aligned from
+    Python threads at once."""
+
+    def __init__(self, a, b, threads=None, probes=3, coarse="fft", verbose=False):
+        self.lib = _load()
+        self.a = _frames(a)
+        self.b = _frames(b)
+        if self.a.shape[1] != self.b.shape[1]:
+            raise ValueError("Channel count mismatch (%d vs. %d)" % (self.a.shape[1], self.b.shape[1]))
+        if coarse not in ("fft", "l1"):
+            raise ValueError("Unknown coarse search method %r" % coarse)
+        self.channels = self.a.shape[1]
+        self.al = _Aligner()
+        self.lib.ka_init(byref(self.al), self.channels)
+        for track, buf in ((self.al.a, self.a), (self.al.b, self.b)):
+            track.len = len(buf)
+            track.buf = buf.ctypes.data_as(POINTER(c_float))
+        if threads:
+            self.al.nthreads = threads
+        self.al.nprobes = probes
+        self.al.coarse_fft = coarse == "fft"
+        self.al.verbose = verbose
+        self.points = None
+
+    def align(self):
+        """Find the control points (a POINT_DTYPE array) mapping a's
+        timeline to b's."""
+        points = np.zeros(self.lib.ka_max_points(byref(self.al)), POINT_DTYPE)
+        count = self.lib.ka_align(byref(self.al), points.ctypes.data)
+        if count < 0:
+            raise Exception("Not enough control points to align the tracks")
+        self.points = points[:count].copy()
+        return self.points
+
+    def render(self, points=None, start=0, frames=None, out=None):
+        """Render frames of a's timeline as b aligned to a, followed by a, as
+        a (frames, 2 * channels) float32 array. Uses the points from the
+        last align() unless given."""
+        if points is None:
+            if self.points is None:
+                self.align()
+            points = self.points
+        points = np.ascontiguousarray(points, dtype=POINT_DTYPE)
+        if len(points) < 2:
+            raise ValueError("At least two control points are needed")
+        if frames is None:
+            frames = len(self.a) - start
+        if out is None:
+            out = np.empty((frames, 2 * self.channels), np.float32)
+        elif out.dtype != np.float32 or out.shape != (frames, 2 * self.channels) or not out.flags.c_contiguous:
+            raise ValueError("out must be a contiguous float32 array of shape %r" % ((frames, 2 * self.channels),))
+        self.lib.ka_render(byref(self.al), points.ctypes.data, len(points),
+                           start, frames, out.ctypes.data)
+        return out
+
+    def close(self):
+        # Also called from __del__ when __init__ failed part way
+        if getattr(self, "al", None) is not None:
+            self.lib.ka_cleanup(byref(self.al))
+            self.al = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+def align(a, b, **kwargs):
+    """Control points aligning b to a, see Aligner."""
+    with Aligner(a, b, **kwargs) as al:
+        return al.align()
+
+def combine(a, b, **kwargs):
+    """Align b to a and render both, like combine_karaoke does."""
+    with Aligner(a, b, **kwargs) as al:
+        al.align()
+        return al.render()
+
+def hash_file(path):
+    """Content hash identifying an input file in alignment maps."""
+    h = c_uint64()
+    if _load().ka_hash_file(os.fsencode(path), byref(h)):
+        raise OSError("Failed to read %s" % path)
+    return h.value
+
+def save_map(path, points, a_path, b_path):
+    """Save control points aligning the audio files a_path and b_path, in
+    the format combine_karaoke -m uses."""
+    points = np.ascontiguousarray(points, dtype=POINT_DTYPE)
+    if _load().ka_save_map(os.fsencode(path), hash_file(a_path), hash_file(b_path),
+                           points.ctypes.data, len(points)):
+        raise OSError("Failed to write %s" % path)
+
+def load_map(path, a_path, b_path, max_points=1 << 20):
+    """Load the control points saved in path, or return None if there are
+    none for these two files."""
+    points = np.zeros(max_points, POINT_DTYPE)
+    count = _load().ka_load_map(os.fsencode(path), hash_file(a_path), hash_file(b_path),
+                                points.ctypes.data, max_points)
+    if count < 0:
+        return None
+    return points[:count].copy()
@@ -0,0 +1,250 @@
+import os, re, json, hashlib, fractions, types
+import importlib.metadata
+
+from blitzloop import layout, song
+
+from media_utils import CACHE_DIR
+
+# Bump when the cached representation changes
+VERSION = 2
+
+# Layouts are stored as JSON: objects of these modules' classes by value
+# (and rebuilt without running their constructors), objects that are part
+# of the song by reference, and fonts and glyphs as the keys they are
+# looked up by, so that loading sets the glyph atlas up again. No other
+# class is ever instantiated from a cache file.
+MODULES = dict((m.__name__, m) for m in (layout, song))
+
+class Uncacheable(Exception):
+    pass
+
+def _blitzloop_version():
+    try:
+        return importlib.metadata.version("blitzloop")
+    except importlib.metadata.PackageNotFoundError:
+        # Running from a checkout, go by the layout code itself
+        st = os.stat(layout.__file__)
+        return "%s:%d:%d" % (layout.__file__, st.st_size, st.st_mtime_ns)
+
+def cache_key(s, variant, renderer):
+    display = getattr(renderer, "display", None)
+    parts = [
+        VERSION,
+        _blitzloop_version(),
+        hashlib.sha1(s.dump().encode("utf-8")).hexdigest(),
+        variant,
+        type(renderer).__module__,
+        type(renderer).__qualname__,
+        getattr(display, "width", None),
+        getattr(display, "height", None),
+    ]
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(repr(part).encode("utf-8") + b"\0")
+    return h.hexdigest()
+
+def _is_value_class(cls):
+    module = MODULES.get(cls.__module__)
+    return module is not None and getattr(module, cls.__name__, None) is cls
+
+def _song_objects(s):
+    """The objects making up a song, in an order that only depends on its
+    contents."""
+    objects = []
+    seen = set()
+    stack = [s]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        if isinstance(obj, (list, tuple)):
+            children = list(obj)
+        elif isinstance(obj, dict):
+            children = [i for item in obj.items() for i in item]
+        elif hasattr(obj, "__dict__") and _is_value_class(type(obj)):
+            objects.append(obj)
+            children = list(vars(obj).values())
+        else:
+            continue
+        seen.add(id(obj))
+        stack.extend(reversed(children))
+    return objects
+
+class _Encoder(object):
+    def __init__(self, lyt):
+        self.shared = {id(lyt.renderer): "renderer"}
+        display = getattr(lyt.renderer, "display", None)
+        if display is not None:
+            self.shared[id(display)] = "display"
+        self.song = dict((id(o), i) for i, o in enumerate(_song_objects(lyt.song)))
+        self.memo = {}
+        # Keep what is memoized alive, so ids stay unique
+        self.keep = []
+
+        # Fonts by index, and every glyph they hold by font, table and key
+        self.font_keys = []
+        self.fonts = {}
+        self.glyphs = {}
+        for key, font in lyt.fonts.items():
+            if not hasattr(font, "get_glyph"):
+                raise Uncacheable("font without get_glyph()")
+            index = len(self.font_keys)
+            self.font_keys.append(self.encode(key))
+            self.fonts[id(font)] = index
+            for attr, table in vars(font).items():
+                if not isinstance(table, dict):
+                    continue
+                for gkey, glyph in table.items():
+                    if isinstance(gkey, (str, int)) and hasattr(glyph, "__dict__"):
+                        self.glyphs[id(glyph)] = [index, attr, gkey]
+
+    def encode(self, obj):
+        if obj is None or isinstance(obj, (bool, int, float, str)):
+            return obj
+        oid = id(obj)
+        if oid in self.shared:
+            return {"s": self.shared[oid]}
+        if oid in self.song:
+            return {"r": self.song[oid]}
+        if oid in self.glyphs:
+            return {"g": self.glyphs[oid]}
+        if oid in self.fonts:
+            return {"f": self.fonts[oid]}
+        if oid in self.memo:
+            return {"m": self.memo[oid]}
+        if isinstance(obj, list):
+            return {"l": [self.encode(i) for i in obj]}
+        if isinstance(obj, tuple):
+            return {"t": [self.encode(i) for i in obj]}
+        if isinstance(obj, dict):
+            return {"d": [[self.encode(k), self.encode(v)] for k, v in obj.items()]}
+        if isinstance(obj, fractions.Fraction):
+            return {"q": [obj.numerator, obj.denominator]}
+        if isinstance(obj, types.MethodType):
+            return {"b": [self.encode(obj.__self__), obj.__func__.__name__]}
+        cls = type(obj)
+        if not hasattr(obj, "__dict__") or not _is_value_class(cls):
+            raise Uncacheable("can't store %s.%s" % (cls.__module__, cls.__qualname__))
+        self.memo[oid] = len(self.memo)
+        self.keep.append(obj)
+        return {"o": [cls.__module__, cls.__name__], "m": self.memo[oid],
+                "v": dict((k, self.encode(v)) for k, v in vars(obj).items())}
+
+class _Decoder(object):
+    def __init__(self, lyt, renderer):
+        self.shared = {"renderer": renderer}
+        display = getattr(renderer, "display", None)
+        if display is not None:
+            self.shared["display"] = display
+        self.song = _song_objects(lyt.song)
+        self.memo = {}
+        self.fonts = []
+        self.lyt = lyt
+
+    def load_fonts(self, keys):
+        # Fonts are created by the layout itself, on the current renderer
+        for key in keys:
+            key = self.decode(key)
+            self.lyt._get_font(key)
+            self.fonts.append(self.lyt.fonts[key])
+
+    def decode(self, enc):
+        if not isinstance(enc, dict):
+            return enc
+        if "o" in enc:
+            module, name = enc["o"]
+            cls = getattr(MODULES[module], name)
+            if not isinstance(cls, type) or not _is_value_class(cls):
+                raise ValueError("%s.%s is not a layout class" % (module, name))
+            # Registered before its attributes, which may refer back to it
+            obj = cls.__new__(cls)
+            self.memo[enc["m"]] = obj
+            obj.__dict__.update((k, self.decode(v)) for k, v in enc["v"].items())
+            return obj
+        (tag, value), = enc.items()
+        if tag == "s":
+            return self.shared[value]
+        if tag == "r":
+            return self.song[value]
+        if tag == "g":
+            index, attr, gkey = value
+            font = self.fonts[index]
+            glyph = font.get_glyph(gkey)
+            if getattr(font, attr).get(gkey) is not glyph:
+                raise ValueError("glyph %r is not where it was cached" % gkey)
+            return glyph
+        if tag == "f":
+            return self.fonts[value]
+        if tag == "m":
+            return self.memo[value]
+        if tag == "l":
+            return [self.decode(i) for i in value]
+        if tag == "t":
+            return tuple(self.decode(i) for i in value)
+        if tag == "d":
+            return dict((self.decode(k), self.decode(v)) for k, v in value)
+        if tag == "q":
+            return fractions.Fraction(*value)
+        if tag == "b":
+            return getattr(self.decode(value[0]), value[1])
+        raise ValueError("unknown cache entry %r" % tag)
+
+def dump_layout(lyt):
+    """The layout as a JSON-compatible object, or raises Uncacheable."""
+    # Loading needs these to set the fonts and atlas up again
+    if not hasattr(lyt, "_get_font") or not hasattr(getattr(lyt.renderer, "atlas", None), "upload"):
+        raise Uncacheable("layout or renderer without font or atlas setup")
+    enc = _Encoder(lyt)
+    state = dict((k, v) for k, v in vars(lyt).items() if k not in ("renderer", "fonts"))
+    return {
+        "fonts": enc.font_keys,
+        "layout": dict((k, enc.encode(v)) for k, v in state.items()),
+    }
+
+def load_layout(data, s, renderer):
+    """Rebuild a layout of s from dump_layout() output, on renderer."""
+    lyt = layout.SongLayout.__new__(layout.SongLayout)
+    lyt.song = s
+    lyt.renderer = renderer
+    lyt.fonts = {}
+    dec = _Decoder(lyt, renderer)
+    dec.load_fonts(data["fonts"])
+    for k, v in data["layout"].items():
+        setattr(lyt, k, dec.decode(v))
+    # What SongLayout does once all glyphs are in the atlas
+    renderer.atlas.upload()
+    return lyt
+
+def get_layout(s, variant, renderer):
+    """Return layout.SongLayout(s, variant, renderer), loading it from the
+    song's cache directory when the song, variant, renderer and blitzloop
+    version are unchanged since it was last built."""
+    cache_dir = os.path.join(s.pathbase or ".", CACHE_DIR)
+    prefix = "layout-%s-" % re.sub(r"[^\w.-]", "_", variant)
+    path = os.path.join(cache_dir, prefix + cache_key(s, variant, renderer) + ".json")
+
+    try:
+        with open(path, "r") as fd:
+            return load_layout(json.load(fd), s, renderer)
+    except (OSError, ValueError, KeyError, IndexError, TypeError, AttributeError):
+        pass
+
+    lyt = layout.SongLayout(s, variant, renderer)
+    try:
+        data = json.dumps(dump_layout(lyt), separators=(",", ":"))
+    except Uncacheable:
+        return lyt
+
+    # The cache is best-effort, like the other .blitz_cache files
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in os.listdir(cache_dir):
+            if name.startswith(prefix):
+                os.unlink(os.path.join(cache_dir, name))
+        tmp = path + ".%d.tmp" % os.getpid()
+        with open(tmp, "w") as fd:
+            fd.write(data)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    return lyt
@@ -0,0 +1,16 @@
+import os
+
+SONG_EXT = ".blitz"
+
+def find_songs(paths):
+    """Yield song files under the given files/directories, in a stable
+    (sorted, depth-first) order."""
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+            for name in sorted(filenames):
+                if name.endswith(SONG_EXT):
+                    yield os.path.join(dirpath, name)
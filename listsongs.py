@@ -1,8 +1,29 @@
 #!/usr/bin/env python3
-import sys
-from blitzloop import songlist
+import os, sys, argparse
 
-song_database = songlist.SongDatabase(sys.argv[1])
+import song_index
+
+parser = argparse.ArgumentParser(description="List the songs in a song directory")
+parser.add_argument(
+    'songdir', metavar='SONGDIR', help='path to the song directory')
+parser.add_argument(
+    '--index-path', metavar='PATH',
+    help='path to the catalogue database (default: SONGDIR/.blitz_index.sqlite)')
+parser.add_argument(
+    '--no-refresh', dest='refresh', action='store_false',
+    help='list the catalogue as is, without looking for new or changed songs')
+parser.add_argument(
+    '--no-index', dest='index', action='store_false',
+    help='parse the song files directly, listing them as they are parsed (no search or sorting)')
+parser.add_argument(
+    '--jobs', type=int, help='number of processes used to parse song files')
+parser.add_argument(
+    '-s', '--search', help='only list songs matching this text (title, artist, album, seen-on or kana)')
+parser.add_argument(
+    '--sort', choices=song_index.SORT_KEYS, default='path', help='sort order')
+parser.add_argument(
+    '-r', '--reverse', action='store_true', help='reverse the sort order')
+opts = parser.parse_args()
 
 def fm(m):
     if not m:
@@ -12,9 +33,24 @@ def fm(m):
     else:
         return m[None]
 
-for song in song_database.songs:
-    print("=== %s ===" % fm(song.meta["title"]))
-    print("By %s - %s" % (fm(song.meta["artist"]), fm(song.meta.get("album",""))))
-    if "seenon" in song.meta:
-        print("From %s" % fm(song.meta["seenon"]))
+def show(meta):
+    print("=== %s ===" % fm(meta.get("title")))
+    print("By %s - %s" % (fm(meta.get("artist")), fm(meta.get("album",""))))
+    if "seenon" in meta:
+        print("From %s" % fm(meta["seenon"]))
     print()
+
+if not opts.index:
+    for path, meta, error in song_index.load_songs([opts.songdir], opts.jobs):
+        if error:
+            print("Failed to parse %s: %s" % (path, error), file=sys.stderr)
+        else:
+            show(dict((k, dict(v)) for k, v in meta.items()))
+    sys.exit(0)
+
+index = song_index.SongIndex(opts.index_path or os.path.join(opts.songdir, ".blitz_index.sqlite"))
+if opts.refresh:
+    index.refresh([opts.songdir], progress=lambda msg: print(msg, file=sys.stderr), jobs=opts.jobs)
+
+for path, meta in index.query(opts.search, opts.sort, opts.reverse):
+    show(meta)
@@ -0,0 +1,266 @@
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+
+# Everything is analyzed at 48kHz, ffmpeg resamples if needed
+RATE = 48000
+# Frames per chunk read from the decoder
+CHUNK = 1 << 18
+
+# ReplayGain 2.0 reference level
+REFERENCE_LUFS = -18.0
+
+# ITU-R BS.1770 K-weighting at 48kHz: high shelf, then RLB high-pass
+K_SHELF = ([1.53512485958697, -2.69169618940638, 1.19839281085285],
+           [1.0, -1.69065929318241, 0.73248077421585])
+K_HIGHPASS = ([1.0, -2.0, 1.0],
+              [1.0, -1.99004745483398, 0.99007225036621])
+# The slowest pole has |z| ~ 0.995, so this is well below float precision
+K_TAPS = 8192
+
+SUBBLOCK = RATE // 10 # 100ms
+BLOCK_SUBBLOCKS = 4 # 400ms gating blocks, 75% overlap
+
+OVERSAMPLE = 4
+PEAK_TAPS_PER_PHASE = 24
+
+def _biquad_impulse(b, a, x):
+    y = []
+    x1 = x2 = y1 = y2 = 0.0
+    for v in x:
+        o = b[0] * v + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+        x2, x1 = x1, v
+        y2, y1 = y1, o
+        y.append(o)
+    return y
+
+def k_weighting_fir():
+    """K-weighting filter impulse response, truncated to K_TAPS. Running the
+    IIR filters sample by sample is hopeless in numpy, but their impulse
+    response decays fast enough to apply them as an FFT convolution."""
+    x = [1.0] + [0.0] * (K_TAPS - 1)
+    x = _biquad_impulse(*K_SHELF, x)
+    x = _biquad_impulse(*K_HIGHPASS, x)
+    return np.array(x)
+
+def oversampling_fir():
+    """Interpolation filter for true peak measurement, as OVERSAMPLE
+    polyphase branches (one FIR per output phase)."""
+    n = OVERSAMPLE * PEAK_TAPS_PER_PHASE
+    t = (np.arange(n) - (n - 1) / 2) / OVERSAMPLE
+    h = np.sinc(t) * np.kaiser(n, 8.0)
+    # Normalize each branch to unity DC gain
+    return [h[p::OVERSAMPLE] / h[p::OVERSAMPLE].sum() for p in range(OVERSAMPLE)]
+
+class StreamingFIR(object):
+    """Bank of FFT overlap-add FIR filters over (frames, channels) chunks of
+    at most max_frames frames, carrying each filter's tail across chunks.
+    The input is transformed once for all filters in the bank."""
+
+    def __init__(self, banks, max_frames, channels):
+        self.ntaps = max(len(taps) for taps in banks)
+        self.max_frames = max_frames
+        self.nfft = 1 << int(np.ceil(np.log2(max_frames + self.ntaps - 1)))
+        self.h = [np.fft.rfft(taps, self.nfft)[:, None] for taps in banks]
+        self.tails = [np.zeros((self.ntaps - 1, channels)) for taps in banks]
+
+    def process(self, x):
+        n = len(x)
+        assert n <= self.max_frames
+        fx = np.fft.rfft(x, self.nfft, axis=0)
+        out = []
+        for i, h in enumerate(self.h):
+            y = np.fft.irfft(fx * h, self.nfft, axis=0)[:n + self.ntaps - 1]
+            y[:self.ntaps - 1] += self.tails[i]
+            self.tails[i] = y[n:].copy()
+            out.append(y[:n])
+        return out
+
+class MixMeter(object):
+    """Integrated loudness (BS.1770 gated) and peak of one stereo mix."""
+
+    def __init__(self):
+        self.subblocks = []
+        self.pending = np.zeros(0)
+        self.peak = 0.0
+
+    def add_power(self, power):
+        power = np.concatenate([self.pending, power])
+        full = len(power) // SUBBLOCK * SUBBLOCK
+        if full:
+            self.subblocks.append(power[:full].reshape(-1, SUBBLOCK).sum(axis=1))
+        self.pending = power[full:]
+
+    def add_peak(self, peak):
+        self.peak = max(self.peak, float(peak))
+
+    def loudness(self):
+        if not self.subblocks:
+            return None
+        sub = np.concatenate(self.subblocks)
+        if len(sub) < BLOCK_SUBBLOCKS:
+            return None
+        csum = np.concatenate([[0], np.cumsum(sub)])
+        blocks = (csum[BLOCK_SUBBLOCKS:] - csum[:-BLOCK_SUBBLOCKS]) / (SUBBLOCK * BLOCK_SUBBLOCKS)
+        with np.errstate(divide="ignore"):
+            lk = -0.691 + 10 * np.log10(blocks)
+        gated = blocks[lk > -70]
+        if not len(gated):
+            return None
+        rel = -0.691 + 10 * np.log10(gated.mean()) - 10
+        gated = blocks[(lk > -70) & (lk > rel)]
+        return -0.691 + 10 * np.log10(gated.mean())
+
+def mix_matrix(channels, pairs):
+    m = np.zeros((channels, 2))
+    for p in pairs:
+        m[2 * p, 0] = 1
+        m[2 * p + 1, 1] = 1
+    return m
+
+def song_mixes(channels, extra=False):
+    """Stereo mixes to analyze for a song with the given number of extra
+    stereo tracks (song.channels). "track" is the mix the track gain has
+    always been computed on; extra adds the instrumental track alone and
+    each stereo track (stem) on its own. Returns (decoded channel count,
+    OrderedDict of name -> track pair list)."""
+    pairs = channels + 1
+    mixes = OrderedDict()
+    if channels == 0:
+        mixes["track"] = [0]
+    elif channels == 1:
+        # Take the second track (with vocals)
+        mixes["track"] = [1]
+    else:
+        # Mix all tracks together
+        mixes["track"] = list(range(pairs))
+    if extra and channels:
+        mixes["instrumental"] = [0]
+        for i in range(pairs):
+            mixes["stem%d" % i] = [i]
+    return 2 * pairs, mixes
+
+# Song key listing the mixes that were silent or too short to measure at
+# the last analysis (comma separated). They get no track_gain keys, and
+# this tells that apart from not having been analyzed.
+UNMEASURED_KEY = "track_gain_unmeasured"
+
+class Analyzer(object):
+    """Feeds decoded float PCM through one K-weighting and one oversampling
+    pass shared by all mixes (both are linear, so filtering the decoded
+    channels and then mixing is the same as mixing and then filtering).
+    All mixes are then computed with a single matrix product."""
+
+    def __init__(self, channels, mixes, max_frames=CHUNK):
+        self.channels = channels
+        self.meters = OrderedDict((name, MixMeter()) for name in mixes)
+        # (channels, 2 * mixes), L/R columns of each mix side by side
+        self.matrix = np.concatenate([mix_matrix(channels, pairs)
+                                      for pairs in mixes.values()], axis=1)
+        self.fir = StreamingFIR([k_weighting_fir()] + oversampling_fir(),
+                                max_frames, channels)
+        self.frames = 0
+
+    def feed(self, pcm):
+        pcm = pcm.astype(np.float64)
+        self.frames += len(pcm)
+        k, *phases = self.fir.process(pcm)
+        y = k @ self.matrix
+        power = y * y
+        power = power[:, 0::2] + power[:, 1::2]
+        peak = np.zeros(self.matrix.shape[1])
+        for x in [pcm] + phases:
+            peak = np.maximum(peak, np.abs(x @ self.matrix).max(axis=0, initial=0))
+        peak = np.maximum(peak[0::2], peak[1::2])
+        for i, meter in enumerate(self.meters.values()):
+            meter.add_power(power[:, i])
+            meter.add_peak(peak[i])
+
+    def feed_bytes(self, data):
+        self.feed(np.frombuffer(data, dtype="<f4").reshape(-1, self.channels))
+
+    def results(self):
+        """Returns name -> (gain in dB, peak as linear amplitude), or None
+        for mixes that are silent or too short to measure."""
+        res = OrderedDict()
+        for name, meter in self.meters.items():
+            lufs = meter.loudness()
+            if lufs is None:
+                res[name] = None
+            else:
+                res[name] = (float(REFERENCE_LUFS - lufs), meter.peak)
+        return res
+
+def decoder_args(channels):
+    """ffmpeg output options producing what Analyzer expects."""
+    return ["-f", "f32le", "-acodec", "pcm_f32le", "-ac", str(channels), "-ar", str(RATE)]
+
+def analyze_stream(fd, channels, mixes, chunk=CHUNK):
+    an = Analyzer(channels, mixes, chunk)
+    size = chunk * channels * 4
+    buf = bytearray(size)
+    view = memoryview(buf)
+    while True:
+        # Fill whole chunks; pipes return short reads
+        got = 0
+        while got < size:
+            n = fd.readinto(view[got:])
+            if not n:
+                break
+            got += n
+        got -= got % (channels * 4)
+        if got:
+            an.feed_bytes(bytes(view[:got]))
+        if got < size:
+            break
+    return an.results()
+
+def analyze_command(cmd, channels, mixes):
+    """Run an ffmpeg command writing decoder_args(channels) PCM to stdout,
+    and analyze its output."""
+    p = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    try:
+        res = analyze_stream(p.stdout, channels, mixes)
+    finally:
+        # Closing the pipe stops ffmpeg if the analysis failed, in which
+        # case that is the error to report
+        p.stdout.close()
+        ret = p.wait()
+    if ret != 0:
+        raise subprocess.CalledProcessError(ret, cmd)
+    return res
+
+def audio_channels(path):
+    """Channel count of each audio stream in a file."""
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-select_streams", "a",
+        "-show_entries", "stream=channels",
+        "-of", "csv=p=0",
+        path
+    ]
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+    return [int(i) for i in p.stdout.split()]
+
+def analyze_file(path, channels, mixes):
+    """Analyze all audio streams of a file, merged into one, which must
+    have the given number of channels."""
+    streams = audio_channels(path)
+    if sum(streams) != channels:
+        raise Exception("%s has %d audio channels in %d streams, expected %d" % (
+            path, sum(streams), len(streams), channels))
+    cmd = [
+        "ffmpeg", "-hide_banner", "-nostats", "-loglevel", "error",
+        "-i", path,
+    ]
+    if len(streams) > 1:
+        cmd += [
+            "-filter_complex",
+            "".join("[0:a:%d]" % i for i in range(len(streams))) +
+            "amerge=inputs=%d[aout]" % len(streams),
+            "-map", "[aout]"
+        ]
+    else:
+        cmd += ["-map", "0:a:0"]
+    return analyze_command(cmd + decoder_args(channels) + ["-"], channels, mixes)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2012-2020 Hector Martin "marcan" <marcan@marcan.st>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 or version 3.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301  USA
+
+from collections import namedtuple
+
+TimedAtom = namedtuple("TimedAtom", "start end text")
+TimedLine = namedtuple("TimedLine", "tag start end atoms")
+
+def build_table(s, variant):
+    """Walk the song's compounds once for the given variant key, returning a
+    flat list of TimedLines (one per compound and tag) with their atoms."""
+    tags = set(s.variants[variant].tag_list)
+    table = []
+    for compound in s.compounds:
+        for tag in compound:
+            if tag not in tags:
+                continue
+            atoms = []
+            step = 0
+            for atom in compound[tag].atoms:
+                start, end = compound.get_atom_time(step, atom.steps)
+                atoms.append(TimedAtom(start, end, atom.text))
+                step += atom.steps
+            start, end = compound.get_atom_time(0, step)
+            table.append(TimedLine(tag, start, end, atoms))
+    return table
+
+def _meta(s, key):
+    if key in s.meta:
+        return s.meta[key][None]
+    return None
+
+class TextWriter(object):
+    ext = None
+
+    def save(self, path, s, variant, table):
+        with open(path, "w", encoding="utf-8") as fd:
+            self.write(fd, s, variant, table)
+
+    def write(self, fd, s, variant, table):
+        raise NotImplementedError()
+
+class ASSWriter(TextWriter):
+    ext = "ass"
+
+    HEADER = """
+[Script Info]
+Title: Default Aegisub file
+ScriptType: v4.00+
+WrapStyle: 0
+ScaledBorderAndShadow: yes
+YCbCr Matrix: TV.601
+PlayResX: 1920
+PlayResY: 1080
+
+[Aegisub Project Garbage]
+Last Style Storage: Default
+Audio File: dummy.flac
+Video File: dummy.flac
+Video AR Mode: 4
+Video AR Value: 1.777778
+Video Zoom Percent: 1.000000
+Active Line: 29
+Video Position: 11024
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Rounded Mplus 1c,90,&H00FFFFFF,&H00ffc080,&H00FF9664,&H6A000000,0,0,0,0,100,100,0,0,1,2.5,3,8,20,20,10,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+
+"""
+
+    OFFSET = -0.22
+    HEADSTART = 60/180 * 1/2
+
+    @staticmethod
+    def ft(t):
+        sec = int(t)
+        cs = int((t - sec) * 100)
+        m = sec // 60
+        sec = sec % 60
+
+        return "0:%02d:%02d.%02d" % (m, sec, cs)
+
+    def write(self, fd, s, variant, table):
+        fd.write(self.HEADER)
+        for line in table:
+            msec = self.HEADSTART * 100
+
+            text = "{\\k%d}" % int(round(msec))
+
+            for atom in line.atoms:
+                lm = int(round(msec))
+                msec += (atom.end - atom.start) * 100
+                text += "{\\k%d}" % (int(round(msec)) - lm)
+                text += atom.text
+
+            st = line.start + self.OFFSET
+            et = line.end + self.OFFSET
+            fd.write("Dialogue: 0,%s,%s,Default,,0,0,0,,%s\n" %
+                (self.ft(st - self.HEADSTART), self.ft(et), text))
+
+class LRCWriter(TextWriter):
+    """Enhanced LRC, with per-atom <mm:ss.xx> timestamps."""
+    ext = "lrc"
+
+    @staticmethod
+    def ft(t):
+        cs = int(round(max(0, t) * 100))
+        return "%02d:%02d.%02d" % (cs // 6000, (cs // 100) % 60, cs % 100)
+
+    def write(self, fd, s, variant, table):
+        for tag, key in (("ti", "title"), ("ar", "artist"), ("al", "album")):
+            val = _meta(s, key)
+            if val:
+                fd.write("[%s:%s]\n" % (tag, val))
+        for line in sorted(table, key=lambda l: l.start):
+            text = "".join("<%s>%s" % (self.ft(a.start), a.text) for a in line.atoms)
+            fd.write("[%s]%s<%s>\n" % (self.ft(line.start), text, self.ft(line.end)))
+
+class WebVTTWriter(TextWriter):
+    ext = "vtt"
+
+    @staticmethod
+    def ft(t):
+        ms = int(round(max(0, t) * 1000))
+        return "%02d:%02d:%02d.%03d" % (ms // 3600000, (ms // 60000) % 60,
+                                        (ms // 1000) % 60, ms % 1000)
+
+    @staticmethod
+    def escape(text):
+        return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+    def write(self, fd, s, variant, table):
+        fd.write("WEBVTT\n\n")
+        for line in sorted(table, key=lambda l: l.start):
+            start = self.ft(line.start)
+            text = ""
+            for atom in line.atoms:
+                # Cue timestamps must lie strictly inside the cue
+                ts = self.ft(atom.start)
+                if start < ts < self.ft(line.end):
+                    text += "<%s>" % ts
+                text += self.escape(atom.text)
+            fd.write("%s --> %s\n%s\n\n" % (start, self.ft(line.end), text))
+
+class JoysoundWriter(object):
+    """Joysound project XML. Unlike the text formats this needs the full
+    screen layout (pages and rows), so it drives JoysoundProject rather
+    than the flat table, and needs a (surfaceless) display."""
+    ext = "xml"
+
+    def __init__(self, pathbase=""):
+        self.pathbase = pathbase
+        self.renderer = None
+
+    def save(self, path, s, variant, table):
+        import joysound_project
+        if self.renderer is None:
+            self.renderer = joysound_project.create_renderer()
+        pro = joysound_project.JoysoundProject(
+            s, self.renderer, list(s.variants.keys()).index(variant),
+            self.pathbase, False)
+        pro.save(path)
+
+WRITERS = {
+    "ass": ASSWriter,
+    "lrc": LRCWriter,
+    "vtt": WebVTTWriter,
+    "joysound": JoysoundWriter,
+}
+
+def output_path(outbase, variant, writer):
+    return "%s.%s.%s" % (outbase, variant, writer.ext)
+
+def export_song(s, outbase, writers, variants=None):
+    """Write every format in writers for every variant (default: all of the
+    song's variants), building the timed atom table once per variant.
+    Returns the list of files written."""
+    if variants is None:
+        variants = list(s.variants.keys())
+    outputs = []
+    for variant in variants:
+        table = build_table(s, variant)
+        for writer in writers:
+            path = output_path(outbase, variant, writer)
+            writer.save(path, s, variant, table)
+            outputs.append(path)
+    return outputs
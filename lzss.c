@@ -0,0 +1,131 @@
+#include <stdlib.h>
+#include <string.h>
+
+#include "lzss.h"
+
+#define WINDOW 0x1000
+#define START 0xfee
+#define MIN_MATCH 3
+#define MAX_MATCH 18
+
+// Hash chains are keyed by a hash of the 3-byte prefix instead of the
+// prefix itself; positions that only share the hash are skipped without
+// counting towards effort, which keeps the output the same as the Python
+// version's
+#define HASH_BITS 15
+
+static inline unsigned hash3(const uint8_t *p)
+{
+    return ((uint32_t)(p[0] << 16 | p[1] << 8 | p[2]) * 2654435761u) >> (32 - HASH_BITS);
+}
+
+long lzss_bound(long n)
+{
+    // A flags byte for every 8 literals
+    return n + (n + 7) / 8;
+}
+
+long lzss_compress(const uint8_t *in, long n, uint8_t *out, int effort, int good_match)
+{
+    long *head = malloc(sizeof(*head) << HASH_BITS);
+    long *prev = malloc(sizeof(*prev) * (n ? n : 1));
+    long i = 0, o = 0, p;
+    unsigned h;
+
+    for (h = 0; h < 1u << HASH_BITS; h++)
+        head[h] = -1;
+
+    while (i < n) {
+        long flags_pos = o++;
+        int flags = 0;
+        int bit;
+        for (bit = 0; bit < 8 && i < n; bit++) {
+            int best_len = 0;
+            long best_pos = 0;
+            int limit = n - i < MAX_MATCH ? n - i : MAX_MATCH;
+            if (limit >= MIN_MATCH) {
+                int chain = effort;
+                int good = good_match < limit ? good_match : limit;
+                long cand;
+                h = hash3(in + i);
+                cand = head[h];
+                prev[i] = cand;
+                head[h] = i;
+                // Matches may run into the bytes being produced, the
+                // decoder copies one byte at a time
+                while (cand >= 0 && i - cand <= WINDOW && chain) {
+                    if (!memcmp(in + cand, in + i, MIN_MATCH)) {
+                        int l = MIN_MATCH;
+                        while (l < limit && in[cand + l] == in[i + l])
+                            l++;
+                        if (l > best_len) {
+                            best_len = l;
+                            best_pos = cand;
+                            if (l >= good)
+                                break;
+                        }
+                        chain--;
+                    }
+                    cand = prev[cand];
+                }
+            }
+            if (best_len >= MIN_MATCH) {
+                int offset = (START + best_pos) & 0xfff;
+                out[o++] = offset & 0xff;
+                out[o++] = ((offset >> 4) & 0xf0) | (best_len - MIN_MATCH);
+                for (p = i + 1; p < i + best_len && p + MIN_MATCH <= n; p++) {
+                    h = hash3(in + p);
+                    prev[p] = head[h];
+                    head[h] = p;
+                }
+                i += best_len;
+            } else {
+                flags |= 1 << bit;
+                out[o++] = in[i++];
+            }
+        }
+        out[flags_pos] = flags;
+    }
+
+    free(head);
+    free(prev);
+    return o;
+}
+
+long lzss_decompress(const uint8_t *in, long n, uint8_t *out, long dsize)
+{
+    uint8_t dict[WINDOW];
+    int bp = START;
+    long p = 0, o = 0;
+
+    memset(dict, 0, sizeof(dict));
+    while (o < dsize) {
+        int flags, bit;
+        if (p >= n)
+            return -1;
+        flags = in[p++];
+        for (bit = 0; bit < 8 && o < dsize; bit++, flags >>= 1) {
+            if (flags & 1) {
+                if (p >= n)
+                    return -1;
+                out[o++] = dict[bp] = in[p++];
+                bp = (bp + 1) & 0xfff;
+            } else {
+                int offset, len, k;
+                if (p + 2 > n)
+                    return -1;
+                offset = ((in[p + 1] << 4) & 0xf00) | in[p];
+                len = (in[p + 1] & 0xf) + MIN_MATCH;
+                p += 2;
+                for (k = 0; k < len; k++) {
+                    uint8_t c = dict[(offset + k) & 0xfff];
+                    if (o < dsize)
+                        out[o++] = c;
+                    dict[bp] = c;
+                    bp = (bp + 1) & 0xfff;
+                }
+            }
+        }
+    }
+    return p;
+}
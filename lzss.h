@@ -0,0 +1,28 @@
+#ifndef LZSS_H
+#define LZSS_H
+
+#include <stdint.h>
+
+/*
+ * LZSS as used by Joysound UJK sections (the data of an SSZL block): groups
+ * of 8 items, each group preceded by a flags byte (LSB first, 1 = literal
+ * byte, 0 = 2-byte reference into a 4096-byte ring buffer that starts at
+ * 0xfee, with a 12-bit position and a 4-bit length - 3).
+ *
+ * These are the C versions of joysound_utils.lzss_compress and
+ * LZSSAdapter's decoder, and give the same results.
+ */
+
+// Size of the output buffer lzss_compress() needs for n input bytes
+long lzss_bound(long n);
+
+// Compress n bytes of in into out, trying up to effort earlier occurrences
+// of each 3-byte prefix and stopping at the first match of good_match
+// bytes. Returns the compressed size.
+long lzss_compress(const uint8_t *in, long n, uint8_t *out, int effort, int good_match);
+
+// Decompress in until dsize bytes were written to out. Returns the number
+// of input bytes used, or -1 if in ends first.
+long lzss_decompress(const uint8_t *in, long n, uint8_t *out, long dsize);
+
+#endif
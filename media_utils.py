@@ -0,0 +1,130 @@
+import os, json, hashlib, subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+# Per-song cache directory, created next to the song file
+CACHE_DIR = ".blitz_cache"
+
+class SidecarCache(object):
+    """JSON cache in a song directory, with entries keyed by file path and
+    invalidated when the file's size or mtime changes."""
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.path = os.path.join(directory, CACHE_DIR, name + ".json")
+        self.dirty = False
+        try:
+            with open(self.path, "r") as fd:
+                self.entries = json.load(fd)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), os.path.abspath(self.directory))
+
+    def _stamp(self, path):
+        st = os.stat(path)
+        return [st.st_size, st.st_mtime_ns]
+
+    def get(self, path):
+        entry = self.entries.get(self._key(path))
+        if entry is None or entry["stamp"] != self._stamp(path):
+            return None
+        return entry["value"]
+
+    def set(self, path, value):
+        self.entries[self._key(path)] = {
+            "stamp": self._stamp(path),
+            "value": value,
+        }
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        # The cache is best-effort; read-only libraries just don't get one
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + ".%d.tmp" % os.getpid()
+            with open(tmp, "w") as fd:
+                json.dump(self.entries, fd, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError:
+            return
+        self.dirty = False
+
+def probe_duration(path):
+    cmd = [
+        "ffprobe", "-v", "error",
+        "-show_entries", "format=duration",
+        "-of", "default=noprint_wrappers=1:nokey=1",
+        path
+    ]
+    p = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+    try:
+        return float(p.stdout.strip())
+    except ValueError:
+        raise Exception("Could not determine duration of %s" % path)
+
+def get_duration(path, cache_dir=None):
+    """Return the duration of a media file in seconds, reading it from the
+    container headers with ffprobe and caching the result."""
+    cache = SidecarCache(cache_dir or os.path.dirname(path), "probe")
+    duration = cache.get(path)
+    if duration is None:
+        duration = probe_duration(path)
+        cache.set(path, duration)
+        cache.save()
+    return duration
+
+def song_duration(song):
+    """Return the duration of a song in seconds: its own duration (or end)
+    override if the song file sets one, otherwise that of its audio file."""
+    for key in ("duration", "end"):
+        if song.song.get(key):
+            return float(song.song[key])
+    return get_duration(song.audiofile, song.pathbase)
+
+HASH_CHUNK = 1 << 20
+
+def md5_file(path):
+    h = hashlib.md5()
+    with open(path, "rb") as fd:
+        while True:
+            chunk = fd.read(HASH_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_md5s(paths, cache_dir, jobs=4):
+    """Return a dict mapping each path to the MD5 of its contents. Files are
+    hashed in chunks, several at a time, and only when they changed since
+    the last time they were hashed."""
+    cache = SidecarCache(cache_dir, "md5")
+    hashes = {}
+    todo = []
+    for path in paths:
+        h = cache.get(path)
+        if h is None:
+            todo.append(path)
+        else:
+            hashes[path] = h
+    if todo:
+        # hashlib releases the GIL while hashing large buffers
+        with ThreadPoolExecutor(max(1, min(jobs, len(todo)))) as ex:
+            for path, h in zip(todo, ex.map(md5_file, todo)):
+                hashes[path] = h
+                cache.set(path, h)
+        cache.save()
+    return hashes
+
+def fingerprint(path, cache_dir, quick=False):
+    """size:mtime:md5 of a file, identifying the audio a stored analysis
+    (such as track_gain) was computed from. With quick, the hash is left
+    empty."""
+    st = os.stat(path)
+    if quick:
+        h = ""
+    else:
+        h = get_md5s([path], cache_dir)[path]
+    return "%d:%d:%s" % (st.st_size, st.st_mtime_ns, h)
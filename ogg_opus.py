@@ -0,0 +1,185 @@
+import struct, zlib
+
+# Multichannel Opus is a set of independently coded elementary streams, with
+# one packet of each per Ogg packet. So stereo Opus files encoded separately
+# can be merged into one multichannel stream without re-encoding, as long as
+# they were encoded with the same settings (frame size and pre-skip).
+# See RFC 6716 (framing) and RFC 7845 (Ogg encapsulation).
+
+PAGE_HEADER = struct.Struct("<4sBBqIIIB")
+OPUS_HEAD = struct.Struct("<8sBBHIhB")
+
+# Packets per page when writing (at most; a page holds 255 lacing values)
+PAGE_PACKETS = 50
+
+BIT_REVERSE = bytes(int("{:08b}".format(i)[::-1], 2) for i in range(256))
+
+def ogg_crc(data):
+    """Ogg's CRC32 (MSB first, no inversion), by way of zlib's (LSB first):
+    bit-reversing the input bytes bit-reverses the register."""
+    crc = zlib.crc32(data.translate(BIT_REVERSE), 0xffffffff) ^ 0xffffffff
+    return int("{:032b}".format(crc)[::-1], 2)
+
+def read_packets(path):
+    """Read the packets of a single-stream Ogg file. Returns the packets and
+    the granule position of the last page."""
+    with open(path, "rb") as fd:
+        data = fd.read()
+    packets = []
+    partial = b""
+    granule = 0
+    pos = 0
+    while pos < len(data):
+        magic, version, flags, granule, serial, seq, crc, nsegs = PAGE_HEADER.unpack_from(data, pos)
+        if magic != b"OggS":
+            raise Exception("%s: bad Ogg page at %d" % (path, pos))
+        pos += PAGE_HEADER.size
+        lacing = data[pos:pos + nsegs]
+        pos += nsegs
+        for l in lacing:
+            partial += data[pos:pos + l]
+            pos += l
+            if l < 255:
+                packets.append(partial)
+                partial = b""
+    return packets, granule
+
+def packet_samples(packet):
+    """Duration of an Opus packet in 48kHz samples."""
+    config = packet[0] >> 3
+    if config < 12:
+        size = (480, 960, 1920, 2880)[config & 3]
+    elif config < 16:
+        size = (480, 960)[config & 1]
+    else:
+        size = (120, 240, 480, 960)[config & 3]
+    code = packet[0] & 3
+    if code == 0:
+        frames = 1
+    elif code < 3:
+        frames = 2
+    else:
+        frames = packet[1] & 0x3f
+    return size * frames
+
+def _length(n):
+    if n < 252:
+        return bytes([n])
+    return bytes([252 + (n & 3), (n - 252) >> 2])
+
+def _read_length(packet, pos):
+    if packet[pos] < 252:
+        return packet[pos], pos + 1
+    return packet[pos] + 4 * packet[pos + 1], pos + 2
+
+def self_delimited(packet):
+    """Convert a packet to the self-delimiting framing used for all but the
+    last stream in a multistream packet (RFC 6716 appendix B), which adds
+    the size of the last frame (or the common frame size) after the TOC
+    and any other sizes."""
+    code = packet[0] & 3
+    if code == 0:
+        return packet[:1] + _length(len(packet) - 1) + packet[1:]
+    if code == 1:
+        return packet[:1] + _length((len(packet) - 1) // 2) + packet[1:]
+    if code == 2:
+        first, pos = _read_length(packet, 1)
+        return packet[:pos] + _length(len(packet) - pos - first) + packet[pos:]
+
+    count = packet[1]
+    frames = count & 0x3f
+    pos = 2
+    padding = 0
+    if count & 0x40:
+        while True:
+            p = packet[pos]
+            pos += 1
+            padding += 254 if p == 255 else p
+            if p != 255:
+                break
+    data = len(packet) - padding
+    if count & 0x80:
+        # VBR: sizes of all but the last frame
+        sizes = 0
+        for i in range(frames - 1):
+            size, pos = _read_length(packet, pos)
+            sizes += size
+        last = data - pos - sizes
+    else:
+        last = (data - pos) // frames
+    return packet[:pos] + _length(last) + packet[pos:]
+
+def _lacing(packet):
+    return b"\xff" * (len(packet) // 255) + bytes([len(packet) % 255])
+
+def _write_page(fd, serial, seq, granule, packets, flags=0):
+    lacing = b"".join(_lacing(p) for p in packets)
+    if len(lacing) > 255:
+        raise Exception("Ogg page overflow")
+    page = PAGE_HEADER.pack(b"OggS", 0, flags, granule, serial, seq, 0, len(lacing)) + lacing + b"".join(packets)
+    crc = ogg_crc(page)
+    fd.write(page[:22] + struct.pack("<I", crc) + page[26:])
+
+def merge_streams(paths, output, pad_packet=None):
+    """Merge stereo Ogg Opus files into one multichannel Ogg Opus file
+    (channel mapping family 255, stream i in channels 2i and 2i + 1). The
+    output is as long as the first file: longer ones are cut, shorter ones
+    padded with pad_packet, which must be a packet of the same duration
+    (normally encoded silence)."""
+    heads = []
+    streams = []
+    for path in paths:
+        packets, granule = read_packets(path)
+        if len(packets) < 2 or not packets[0].startswith(b"OpusHead"):
+            raise Exception("%s is not an Ogg Opus file" % path)
+        head = OPUS_HEAD.unpack_from(packets[0])
+        if head[2] != 2 or head[6] != 0:
+            raise Exception("%s is not a stereo Opus stream" % path)
+        heads.append(head)
+        streams.append((packets[2:], granule))
+
+    magic, version, channels, pre_skip, rate, gain, family = heads[0]
+    if any(h[3] != pre_skip for h in heads):
+        raise Exception("Opus streams have different pre-skip")
+    packets, end_granule = streams[0]
+    sizes = [packet_samples(p) for p in packets]
+
+    merged = []
+    for i in range(len(packets)):
+        parts = []
+        for other, granule in streams:
+            p = other[i] if i < len(other) else pad_packet
+            if p is None:
+                raise Exception("Opus stream too short and no padding given")
+            if packet_samples(p) != sizes[i]:
+                raise Exception("Opus streams have different frame sizes")
+            parts.append(p)
+        merged.append(b"".join(self_delimited(p) for p in parts[:-1]) + parts[-1])
+
+    n = len(paths)
+    head = OPUS_HEAD.pack(b"OpusHead", 1, 2 * n, pre_skip, rate, 0, 255)
+    head += bytes([n, n]) + bytes(range(2 * n))
+    tags = b"OpusTags" + struct.pack("<I", 8) + b"ogg_opus" + struct.pack("<I", 0)
+
+    serial = 0x4f707573
+    with open(output, "wb") as fd:
+        _write_page(fd, serial, 0, 0, [head], flags=2)
+        _write_page(fd, serial, 1, 0, [tags])
+        seq = 2
+        granule = 0
+        i = 0
+        while i < len(merged):
+            j = i
+            segments = 0
+            while j < len(merged) and j - i < PAGE_PACKETS:
+                segments += len(merged[j]) // 255 + 1
+                if segments > 255 and j > i:
+                    break
+                j += 1
+            granule += sum(sizes[i:j])
+            last = j == len(merged)
+            # The last page's granule position trims the end padding
+            _write_page(fd, serial, seq, end_granule if last else granule,
+                        merged[i:j], flags=4 if last else 0)
+            seq += 1
+            i = j
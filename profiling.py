@@ -0,0 +1,256 @@
+import os, time, json, tracemalloc, contextlib
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def percentile(values, p):
+    """Linearly interpolated percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    pos = (len(values) - 1) * p / 100.0
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+def histogram(values, buckets):
+    """Count values (in seconds) into buckets given as upper bounds in ms.
+    The last bucket catches everything above the last bound."""
+    counts = [0] * (len(buckets) + 1)
+    for v in values:
+        ms = v * 1000
+        for i, bound in enumerate(buckets):
+            if ms <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+    return counts
+
+HIST_BUCKETS = [0.5, 1, 2, 4, 8, 16, 33, 66, 133, 266]
+
+class NullFrameProfiler(object):
+    def start_frame(self):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def end_frame(self):
+        pass
+
+class FrameProfiler(object):
+    """Collects per-frame timings of named stages.
+
+    Call start_frame() at the top of a frame, mark(stage) after each stage
+    (which accounts the time since the previous mark to that stage) and
+    end_frame() once the frame is done."""
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.samples = dict((s, []) for s in self.stages)
+        self.samples["frame"] = []
+        self.t_start = None
+        self.t_frame = None
+        self.t_last = None
+        self.current = None
+
+    def start_frame(self):
+        self.t_frame = self.t_last = time.perf_counter()
+        if self.t_start is None:
+            self.t_start = self.t_frame
+        self.current = {}
+
+    def mark(self, stage):
+        t = time.perf_counter()
+        self.current[stage] = self.current.get(stage, 0) + t - self.t_last
+        self.t_last = t
+
+    def end_frame(self):
+        for stage, v in self.current.items():
+            if stage not in self.samples:
+                self.stages.append(stage)
+                self.samples[stage] = []
+            self.samples[stage].append(v)
+        self.samples["frame"].append(time.perf_counter() - self.t_frame)
+
+    def summary(self):
+        frames = len(self.samples["frame"])
+        wall = (self.t_last - self.t_start) if frames else 0
+        report = {
+            "frames": frames,
+            "wall_time": wall,
+            "fps": frames / wall if wall else 0,
+            "histogram_buckets_ms": HIST_BUCKETS,
+            "stages": {},
+        }
+        for stage in self.stages + ["frame"]:
+            values = sorted(self.samples[stage])
+            if not values:
+                continue
+            total = sum(values)
+            report["stages"][stage] = {
+                "count": len(values),
+                "total": total,
+                "share": total / wall if wall else 0,
+                "mean": total / len(values),
+                "min": values[0],
+                "max": values[-1],
+                "p50": percentile(values, 50),
+                "p95": percentile(values, 95),
+                "p99": percentile(values, 99),
+                "histogram": histogram(values, HIST_BUCKETS),
+            }
+        return report
+
+    def print_report(self, report=None):
+        if report is None:
+            report = self.summary()
+        print("%d frames in %.02fs (%.02f fps)" % (
+            report["frames"], report["wall_time"], report["fps"]))
+        print("%-16s %8s %6s %8s %8s %8s %8s" % (
+            "stage", "total", "share", "mean", "p50", "p95", "p99"))
+        for stage, st in report["stages"].items():
+            print("%-16s %7.02fs %5.01f%% %6.02fms %6.02fms %6.02fms %6.02fms" % (
+                stage, st["total"], 100 * st["share"], 1000 * st["mean"],
+                1000 * st["p50"], 1000 * st["p95"], 1000 * st["p99"]))
+        for stage, st in report["stages"].items():
+            print()
+            print("%s:" % stage)
+            peak = max(st["histogram"]) or 1
+            labels = ["<= %gms" % b for b in report["histogram_buckets_ms"]]
+            labels.append("> %gms" % report["histogram_buckets_ms"][-1])
+            for label, count in zip(labels, st["histogram"]):
+                print("  %10s %7d %s" % (label, count, "#" * (40 * count // peak)))
+
+    def write_report(self, path):
+        report = self.summary()
+        with open(path, "w") as fd:
+            json.dump(report, fd, indent=2)
+        return report
+
+class NullStageProfiler(object):
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def count(self, name, n=1):
+        pass
+
+class StageProfiler(object):
+    """Wall time, CPU time and peak memory of named pipeline stages, plus
+    counters for the objects they process.
+
+    Stages are context managers from stage(name) and may nest; nested
+    stages are reported as "outer/inner", and their time is also part of
+    the outer stage. A stage entered more than once is accumulated. CPU
+    time is split between this process and child processes (ffmpeg).
+
+    Each stage records the process' peak RSS as of its end, which is cheap
+    but only shows which stage raised the high-water mark. With memory,
+    allocations are also traced with tracemalloc to find each stage's own
+    peak, which slows Python-heavy stages down many times over."""
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stages = {}
+        self.counts = {}
+        self.stack = []
+        self.t_start = time.perf_counter()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _enter(self, name):
+        path = "/".join([s["name"] for s in self.stack] + [name])
+        if self.memory:
+            if self.stack:
+                self.stack[-1]["peak"] = max(self.stack[-1]["peak"],
+                                             tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        # Created on entry so that the report lists stages in order
+        self.stages.setdefault(path, {
+            "count": 0, "wall": 0.0, "cpu": 0.0, "child_cpu": 0.0})
+        t = os.times()
+        self.stack.append({
+            "name": name,
+            "path": path,
+            "wall": time.perf_counter(),
+            "cpu": t.user + t.system,
+            "child_cpu": t.children_user + t.children_system,
+            "peak": 0,
+        })
+
+    def _exit(self):
+        t = os.times()
+        wall = time.perf_counter()
+        cur = self.stack.pop()
+        st = self.stages[cur["path"]]
+        st["count"] += 1
+        st["wall"] += wall - cur["wall"]
+        st["cpu"] += t.user + t.system - cur["cpu"]
+        st["child_cpu"] += t.children_user + t.children_system - cur["child_cpu"]
+        if resource:
+            # kB on Linux
+            st["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if self.memory:
+            peak = max(cur["peak"], tracemalloc.get_traced_memory()[1])
+            st["peak_mem"] = max(st.get("peak_mem", 0), peak)
+            if self.stack:
+                self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def summary(self):
+        report = {
+            "wall_time": time.perf_counter() - self.t_start,
+            "stages": self.stages,
+            "counts": self.counts,
+        }
+        if resource:
+            report["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return report
+
+    def print_report(self, report=None):
+        if report is None:
+            report = self.summary()
+        print("%.02fs total" % report["wall_time"])
+        print("%-24s %6s %9s %9s %9s %9s %9s" % (
+            "stage", "count", "wall", "cpu", "child cpu", "max rss", "peak mem"))
+        for name, st in report["stages"].items():
+            rss = "%8.01fM" % (st["max_rss_kb"] / 1024) if "max_rss_kb" in st else ""
+            mem = "%8.01fM" % (st["peak_mem"] / 1048576) if "peak_mem" in st else ""
+            print("%-24s %6d %8.03fs %8.03fs %8.03fs %9s %9s" % (
+                name, st["count"], st["wall"], st["cpu"], st["child_cpu"], rss, mem))
+        for name, n in report["counts"].items():
+            print("%s: %d" % (name, n))
+
+    def write_report(self, path, **extra):
+        report = self.summary()
+        report.update(extra)
+        with open(path, "w") as fd:
+            json.dump(report, fd, indent=2)
+        return report
+
+# Profiler for library code (parsers, importers) to report stages to, so
+# that they don't need one passed around. Scripts install one with
+# set_profiler() when profiling is requested.
+_profiler = NullStageProfiler()
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler or NullStageProfiler()
+
+def stage(name):
+    return _profiler.stage(name)
+
+def count(name, n=1):
+    _profiler.count(name, n)
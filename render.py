@@ -25,6 +25,10 @@ import ctypes
 
 from blitzloop import graphics, layout, mpvplayer, song, util
 
+import layout_cache
+import media_utils
+import profiling
+
 parser = util.get_argparser()
 parser.add_argument(
     'songpath', metavar='SONGPATH', help='path to the song file')
@@ -44,6 +48,10 @@ parser.add_argument(
     '--variant', type=int, default=0, help='song variant')
 parser.add_argument(
     '--length', type=float, help='render only this long')
+parser.add_argument(
+    '--no-layout-cache', dest='layout_cache', action='store_false', help='always lay out the song from scratch')
+parser.add_argument(
+    '--profile', metavar='REPORT', help='record per-frame stage timings and write a JSON report')
 parser.add_argument(
     'ffmpeg_opts', metavar='OPTS', nargs=argparse.REMAINDER, help='ffmpeg options')
 opts = util.get_opts()
@@ -60,17 +68,20 @@ display = graphics.Display(opts.width, opts.height)
 import OpenGL.GLES3 as gl
 
 renderer = graphics.get_renderer().KaraokeRenderer(display)
-layout = layout.SongLayout(s, list(s.variants.keys())[opts.variant], renderer)
-
-# Get duration of the audio path
-mpv = mpvplayer.Player(display)
-mpv.load_song(s)
-duration = mpv.duration or mpv.file_duration
+variant = list(s.variants.keys())[opts.variant]
+if opts.layout_cache:
+    layout = layout_cache.get_layout(s, variant, renderer)
+else:
+    layout = layout.SongLayout(s, variant, renderer)
 
 # Now run for rendering using only video
 mpv = mpvplayer.Player(display, rendering=True)
 mpv.load_song(s)
 
+# Use the song's duration if it has one, otherwise read that of the audio
+# from the container (without starting an audio player just for that)
+duration = mpv.duration or media_utils.song_duration(s)
+
 if not opts.video:
     mpv.shutdown()
 print("Song duration: %f" % duration)
@@ -124,26 +135,41 @@ ffmpeg = subprocess.Popen(args, stdin=subprocess.PIPE)
 
 buf = ctypes.create_string_buffer(opts.width * opts.height * 4)
 
+if opts.profile:
+    # ffmpeg_write is the time spent blocked on ffmpeg backpressure
+    prof = profiling.FrameProfiler(["mpv_draw", "renderer_draw", "gl_finish",
+                                    "read_pixels", "ffmpeg_write", "main_loop"])
+else:
+    prof = profiling.NullFrameProfiler()
+
 def render():
     global song_time
     try:
         mpv.play()
         while song_time < duration:
+            prof.start_frame()
             if opts.video:
                 mpv.draw()
                 mpv.poll()
                 mpv.draw_fade(song_time)
+                prof.mark("mpv_draw")
             renderer.draw(song_time + opts.sync, layout)
+            prof.mark("renderer_draw")
             gl.glFinish()
+            prof.mark("gl_finish")
             gl.glReadBuffer(gl.GL_BACK)
             data = None
             gl.glReadPixels(0, 0, opts.width, opts.height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, buf)
+            prof.mark("read_pixels")
             ffmpeg.stdin.write(buf)
+            prof.mark("ffmpeg_write")
             print("\r%.02f%%  " % (100 * song_time / duration), end=' ')
             song_time += 1.0 / opts.fps
             yield None
             if opts.video:
                 mpv.flip()
+            prof.mark("main_loop")
+            prof.end_frame()
     except Exception as e:
         print(e)
     finally:
@@ -151,6 +177,9 @@ def render():
         ffmpeg.wait()
         if opts.video:
             mpv.shutdown()
+        if opts.profile:
+            print()
+            prof.print_report(prof.write_report(opts.profile))
         os._exit(0)
 
 pause = False
@@ -0,0 +1,172 @@
+import os, json, sqlite3
+import multiprocessing
+
+from blitzloop import song
+
+import library
+
+# Metadata fields that are indexed and searchable
+FIELDS = ["title", "artist", "album", "seenon"]
+SORT_KEYS = FIELDS + ["path"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS songs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime INTEGER NOT NULL,
+    meta TEXT NOT NULL,
+    title TEXT, artist TEXT, album TEXT, seenon TEXT,
+    kana TEXT
+);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS songs_fts USING fts5(
+    title, artist, album, seenon, kana,
+    content='songs', content_rowid='id', tokenize='%s'
+);
+CREATE TRIGGER IF NOT EXISTS songs_ai AFTER INSERT ON songs BEGIN
+    INSERT INTO songs_fts(rowid, title, artist, album, seenon, kana)
+    VALUES (new.id, new.title, new.artist, new.album, new.seenon, new.kana);
+END;
+CREATE TRIGGER IF NOT EXISTS songs_ad AFTER DELETE ON songs BEGIN
+    INSERT INTO songs_fts(songs_fts, rowid, title, artist, album, seenon, kana)
+    VALUES ('delete', old.id, old.title, old.artist, old.album, old.seenon, old.kana);
+END;
+CREATE TRIGGER IF NOT EXISTS songs_au AFTER UPDATE ON songs BEGIN
+    INSERT INTO songs_fts(songs_fts, rowid, title, artist, album, seenon, kana)
+    VALUES ('delete', old.id, old.title, old.artist, old.album, old.seenon, old.kana);
+    INSERT INTO songs_fts(rowid, title, artist, album, seenon, kana)
+    VALUES (new.id, new.title, new.artist, new.album, new.seenon, new.kana);
+END;
+"""
+
+def song_metadata(path):
+    """Extract the indexed metadata of a song file, as a dict of field ->
+    list of (language key, text) pairs."""
+    s = song.Song(path)
+    return dict((k, list(s.meta[k].items())) for k in FIELDS if k in s.meta)
+
+def _parse(path):
+    try:
+        return path, song_metadata(path), None
+    except Exception as e:
+        return path, None, "%s: %s" % (type(e).__name__, e)
+
+def parse_songs(songpaths, jobs=None):
+    """Parse the metadata of song files on a process pool, yielding
+    (path, metadata, error) in the order of songpaths as soon as each one
+    is available. songpaths may be a lazy iterator."""
+    with multiprocessing.Pool(jobs) as pool:
+        for result in pool.imap(_parse, songpaths, chunksize=4):
+            yield result
+
+def load_songs(paths, jobs=None):
+    """Like parse_songs(), for all songs found under paths."""
+    return parse_songs(library.find_songs(paths), jobs)
+
+class SongIndex(object):
+    """Persistent SQLite catalogue of song metadata, refreshed incrementally
+    based on song file mtimes."""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+        self.fts = False
+        # trigram lets CJK titles match on substrings; unicode61 only splits
+        # on spaces and punctuation, which is all older SQLite has
+        for tokenizer in ("trigram", "unicode61"):
+            try:
+                self.db.executescript(FTS_SCHEMA % tokenizer)
+                break
+            except sqlite3.OperationalError:
+                continue
+        self.db.commit()
+        # An existing index keeps whatever tokenizer it was created with
+        row = self.db.execute("SELECT sql FROM sqlite_master WHERE name = 'songs_fts'").fetchone()
+        if row:
+            self.fts = "trigram" if "trigram" in row[0] else "unicode61"
+
+    def close(self):
+        self.db.close()
+
+    def _row(self, path, mtime, meta):
+        row = {"path": path, "mtime": mtime, "meta": json.dumps(meta, ensure_ascii=False)}
+        kana = []
+        for k in FIELDS:
+            values = dict(meta.get(k, []))
+            row[k] = values.get(None)
+            if values.get("k"):
+                kana.append(values["k"])
+        row["kana"] = " ".join(kana)
+        return row
+
+    def refresh(self, paths, progress=None, jobs=None):
+        """Bring the index up to date with the song files under paths,
+        parsing changed songs on jobs processes. Returns (added/updated,
+        removed) counts."""
+        known = dict(self.db.execute("SELECT path, mtime FROM songs"))
+        seen = set()
+        changed = {}
+        for songpath in library.find_songs(paths):
+            songpath = os.path.abspath(songpath)
+            seen.add(songpath)
+            mtime = os.stat(songpath).st_mtime_ns
+            if known.get(songpath) != mtime:
+                changed[songpath] = mtime
+
+        updated = 0
+        if len(changed) == 1:
+            results = map(_parse, changed)
+        elif changed:
+            results = parse_songs(changed, jobs)
+        else:
+            results = []
+        for songpath, meta, error in results:
+            if error:
+                if progress:
+                    progress("Failed to parse %s: %s" % (songpath, error))
+                continue
+            self.store(songpath, changed[songpath], meta)
+            updated += 1
+
+        roots = [os.path.join(os.path.abspath(p), "") for p in paths]
+        gone = [p for p in known if p not in seen and any(p.startswith(r) for r in roots)]
+        for p in gone:
+            self.db.execute("DELETE FROM songs WHERE path = ?", (p,))
+        self.db.commit()
+        return updated, len(gone)
+
+    def store(self, path, mtime, meta):
+        row = self._row(path, mtime, meta)
+        cur = self.db.execute("SELECT id FROM songs WHERE path = ?", (path,)).fetchone()
+        cols = ["mtime", "meta", "kana"] + FIELDS
+        if cur:
+            self.db.execute("UPDATE songs SET %s WHERE id = ?" % ", ".join("%s = ?" % c for c in cols),
+                            [row[c] for c in cols] + [cur[0]])
+        else:
+            cols.append("path")
+            self.db.execute("INSERT INTO songs (%s) VALUES (%s)" % (", ".join(cols), ", ".join("?" * len(cols))),
+                            [row[c] for c in cols])
+
+    def query(self, search=None, sort="path", reverse=False):
+        """Yield (path, meta) for songs matching search (over title, artist,
+        album, seen-on and kana readings), sorted by sort."""
+        assert sort in SORT_KEYS
+        order = "%s COLLATE NOCASE %s, path" % ("s." + sort, "DESC" if reverse else "ASC")
+        if not search:
+            cur = self.db.execute("SELECT s.path, s.meta FROM songs s ORDER BY " + order)
+        elif self.fts and (self.fts != "trigram" or len(search) >= 3):
+            phrase = '"%s"' % search.replace('"', '""')
+            if self.fts != "trigram":
+                phrase += "*"
+            cur = self.db.execute(
+                "SELECT s.path, s.meta FROM songs_fts f JOIN songs s ON s.id = f.rowid "
+                "WHERE songs_fts MATCH ? ORDER BY " + order, (phrase,))
+        else:
+            like = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            cond = " OR ".join("s.%s LIKE ? ESCAPE '\\'" % c for c in FIELDS + ["kana"])
+            cur = self.db.execute("SELECT s.path, s.meta FROM songs s WHERE %s ORDER BY %s" % (cond, order),
+                                  [like] * (len(FIELDS) + 1))
+        for path, meta in cur:
+            yield path, dict((k, dict(items)) for k, items in json.loads(meta).items())
@@ -0,0 +1,94 @@
+/*
+ * Checks that the alignment does not depend on the number of fine search
+ * threads, on a synthetic pair where B drifts against A.
+ */
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <math.h>
+
+#include "karaoke_align.h"
+
+#define RATE 44100
+#define LEN (RATE * 60)
+#define CHANNELS 2
+#define START_OFFSET 1234.0
+
+static uint32_t rng_state = 1;
+
+static float noise(void)
+{
+    rng_state = rng_state * 1664525 + 1013904223;
+    return (rng_state >> 8) / (float)(1 << 24) - 0.5f;
+}
+
+// A: noise under a slow envelope, B: A played faster by drift
+static void make_tracks(float *a, float *b, double drift)
+{
+    long i;
+    int ch;
+    for (i = 0; i < LEN + RATE; i++) {
+        float env = sinf(i * 7.3f / RATE);
+        env = env * env + 0.2f;
+        for (ch = 0; ch < CHANNELS; ch++)
+            a[i * CHANNELS + ch] = 0.4f * env * noise();
+    }
+    for (i = 0; i < LEN; i++) {
+        double t = i * (1 + drift) + START_OFFSET;
+        long j = (long)t;
+        float f = t - j;
+        for (ch = 0; ch < CHANNELS; ch++)
+            b[i * CHANNELS + ch] = (1 - f) * a[j * CHANNELS + ch] + f * a[(j + 1) * CHANNELS + ch];
+    }
+}
+
+static int align(const float *a, const float *b, int nthreads, struct ka_point *points)
+{
+    struct ka_aligner al;
+    ka_init(&al, CHANNELS);
+    al.nthreads = nthreads;
+    al.a.len = al.b.len = LEN;
+    al.a.buf = a;
+    al.b.buf = b;
+    int npoints = ka_align(&al, points);
+    ka_cleanup(&al);
+    return npoints;
+}
+
+int main(void)
+{
+    static const double drifts[] = {0.00002, -0.0002, 0.0005};
+    static const int threads[] = {2, 5, 16};
+    float *a = malloc(sizeof(float) * CHANNELS * (LEN + RATE));
+    float *b = malloc(sizeof(float) * CHANNELS * LEN);
+    int max_points = LEN / 25000 + 1;
+    struct ka_point *ref = malloc(sizeof(*ref) * max_points);
+    struct ka_point *points = malloc(sizeof(*points) * max_points);
+    int failed = 0;
+    unsigned i, j;
+
+    for (i = 0; i < sizeof(drifts) / sizeof(drifts[0]); i++) {
+        make_tracks(a, b, drifts[i]);
+        int nref = align(a, b, 1, ref);
+        printf("drift %g: %d points with 1 thread\n", drifts[i], nref);
+        if (nref < max_points / 3) {
+            printf("  too few points\n");
+            failed = 1;
+        }
+        for (j = 0; j < sizeof(threads) / sizeof(threads[0]); j++) {
+            int n = align(a, b, threads[j], points);
+            if (n != nref || (n > 0 && memcmp(points, ref, sizeof(*ref) * n))) {
+                printf("  %d points with %d threads, differing\n", n, threads[j]);
+                failed = 1;
+            }
+        }
+    }
+
+    free(a);
+    free(b);
+    free(ref);
+    free(points);
+    if (failed)
+        printf("FAILED\n");
+    return failed;
+}
@@ -0,0 +1,71 @@
+/*
+ * Round-trips a few kinds of data through the LZSS encoder and decoder,
+ * at several efforts, and checks that truncated input is rejected.
+ */
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+#include "lzss.h"
+
+#define LEN 100000
+
+static uint32_t rng_state = 1;
+
+static uint8_t rnd(void)
+{
+    rng_state = rng_state * 1664525 + 1013904223;
+    return rng_state >> 24;
+}
+
+static int check(const char *name, const uint8_t *data, long n)
+{
+    static const int efforts[] = {0, 1, 4, 64};
+    uint8_t *comp = malloc(lzss_bound(n) + 1);
+    uint8_t *dec = malloc(n + 1);
+    int failed = 0;
+    unsigned i;
+
+    for (i = 0; i < sizeof(efforts) / sizeof(efforts[0]); i++) {
+        long csize = lzss_compress(data, n, comp, efforts[i], 8);
+        long used = lzss_decompress(comp, csize, dec, n);
+        if (csize > lzss_bound(n) || used != csize || memcmp(data, dec, n)) {
+            printf("%s: round trip failed at effort %d\n", name, efforts[i]);
+            failed = 1;
+        }
+        if (n > 0 && lzss_decompress(comp, csize - 1, dec, n) != -1) {
+            printf("%s: truncated data accepted at effort %d\n", name, efforts[i]);
+            failed = 1;
+        }
+        if (efforts[i] == 4)
+            printf("%s: %ld -> %ld bytes\n", name, n, csize);
+    }
+    free(comp);
+    free(dec);
+    return failed;
+}
+
+int main(void)
+{
+    uint8_t *data = malloc(LEN);
+    int failed = 0;
+    long i;
+
+    memset(data, 0, LEN);
+    failed |= check("empty", data, 0);
+    failed |= check("zeros", data, LEN);
+    for (i = 0; i < LEN; i++)
+        data[i] = rnd();
+    failed |= check("random", data, LEN);
+    for (i = 0; i < LEN; i++)
+        data[i] = "abcdefgh"[rnd() & 7];
+    failed |= check("semirandom", data, LEN);
+    for (i = 0; i < LEN; i++)
+        data[i] = i % 7 ? data[i - 1] : rnd();
+    failed |= check("runs", data, LEN);
+
+    free(data);
+    if (failed)
+        printf("FAILED\n");
+    return failed;
+}
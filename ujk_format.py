@@ -109,10 +109,10 @@ UJKFile = Struct(
         Bytes(this.offsets.title_size)
     ),
     "lyrics" / Pointer(this.offsets.lyrics_off,
-        LZSSAdapter(RawCopy(JoyU2File))
+        LZSSAdapter(RawCopy(JoyU2File), stage="lyrics")
     ),
     "fonts" / Pointer(this.offsets.fonts_off,
-        LZSSAdapter(RawCopy(FontFile))
+        LZSSAdapter(RawCopy(FontFile), stage="fonts")
     ),
     "audio" / Pointer(this.offsets.audio_off,
         FixedSized(this.offsets.audio_size, AudioFile)